@@ -1,17 +1,67 @@
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import queue
 import math
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import urllib3
 from datetime import datetime, timedelta
 import os
 import glob
+import argparse
+import hashlib
+import subprocess
+import sys
+import gzip
+import threading
+import functools
+import time
+import re
+import urllib.parse
+from contextlib import contextmanager
+import random
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from requests.structures import CaseInsensitiveDict
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 dry_run = True
 environment = 'Test'
 log_retention_days = 30
+log_max_bytes = 50 * 1024 * 1024
+log_backup_count = 20
+member_log_summary = True  # one log line per provisioned member instead of one per step
+page_size = 100
+max_workers = 8
+keyfactor_rate_limit = 25  # requests per second
+graph_rate_limit = 25  # requests per second
+max_retries = 5
+max_backoff_seconds = 60
+permission_set_ttl = 0  # seconds, 0 keeps permission sets cached for the whole run
+incremental = False
+delta_state_file = "entra_delta_state.json"
+full_resync_hours = 24
+use_snapshot = False  # dry runs plan against a local snapshot of the Keyfactor roles and claims
+refresh_snapshot = False
+snapshot_file = "keyfactor_snapshot.json.gz"
+snapshot_ttl_minutes = 60
+stream_members = False  # reconcile members as Graph pages arrive instead of planning them all first
+member_queue_size = 1000
+metrics_file = "provisioning_metrics.json"
+prometheus_textfile = ""  # e.g. /var/lib/node_exporter/textfile_collector/auto_provision.prom
+report_file = "provisioning_report.json"
+journal_file = "provisioning_journal.jsonl"
+journal_fsync_batch = 100  # records written between two syncs of the journal to disk
+journal_fsync_seconds = 2
+prune_orphans = False  # delete the roles and claims of groups no longer under the parent groups
+max_deletions = 50  # pruning is skipped when more orphans than this are found
+prune_batch_size = 100
+shard_count = 1  # split the members across this many shards, see --shard-index
+shard_index = 0
 proxies = {
     # 'http': 'http://127.0.0.1:7890',
     # 'https': 'http://127.0.0.1:7890'
@@ -61,20 +111,192 @@ def load_variables(environment='Test'):  # Default to Test environment
             'MODULE_LOGGER_NAME': "test_provisioning"
         }
 
+def parse_arguments():
+    """
+    Parses the command-line arguments. Every argument is optional and falls back to the settings
+    at the top of the script.
+
+    :return: The parsed arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Provision Keyfactor Command roles and claims from Entra groups.")
+    parser.add_argument('--shard-count', type=int, default=shard_count,
+                        help='Number of shards the Entra groups are split across')
+    parser.add_argument('--shard-index', type=int, default=shard_index,
+                        help='Shard processed by this run, from 0 to shard-count - 1')
+    parser.add_argument('--spawn-shards', action='store_true',
+                        help='Run every shard as a local process, then merge their reports')
+    parser.add_argument('--merge-reports', action='store_true',
+                        help='Merge the reports written by every shard into a single report and exit')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the work recorded in the journal of an interrupted run')
+    args = parser.parse_args()
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    return args
+
+def shard_file(path: str) -> str:
+    """
+    Returns the file name used by the current shard for a per-run file, so shards running side by
+    side in the same directory never write to the same log, metrics, report or state file.
+
+    :param path: The file name used when the members are not sharded.
+    :type path: str
+    :return: The file name with the shard appended before the extension, or ``path`` unchanged
+        when ``shard_count`` is 1.
+    :rtype: str
+    """
+    if shard_count == 1 or not path:
+        return path
+    root, extension = os.path.splitext(path)
+    if extension == ".gz":
+        root, inner_extension = os.path.splitext(root)
+        extension = inner_extension + extension
+    return f"{root}_shard{shard_index}of{shard_count}{extension}"
+
+def member_shard(member_name: str, count: int) -> int:
+    """
+    Returns the shard a member belongs to, from a stable hash of its display name.
+
+    The hash does not depend on the process or host, so every shard agrees on which shard owns
+    each member and a claim or role is never created by two shards.
+
+    :param member_name: The display name of the member.
+    :type member_name: str
+    :param count: The number of shards.
+    :type count: int
+    :return: The shard index, from 0 to ``count`` - 1.
+    :rtype: int
+    """
+    digest = hashlib.sha1(member_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+def filter_shard(entra_members):
+    """
+    Yields only the members that belong to the current shard.
+
+    :param entra_members: Entra group objects.
+    :type entra_members: Iterable[dict]
+    :return: Generator of the group objects of this shard.
+    :rtype: Iterator[dict]
+    """
+    for member in entra_members:
+        member_name = member.get("displayName")
+        if member_name and member_shard(member_name, shard_count) == shard_index:
+            yield member
+
+def write_report(plan, results: dict, pruned: dict = None):
+    """
+    Writes the report of the run, with the plan totals, the outcome of every changed member and
+    the outcome of the pruning pass, to the shard's report file.
+
+    :param plan: The plan, or totals, of the run.
+    :type plan: ReconciliationPlan
+    :param results: The outcome of each changed member keyed by member name.
+    :type results: dict
+    :param pruned: The outcome of each orphaned role and claim from prune_orphan_groups, or None
+        when pruning did not run.
+    :type pruned: dict | None
+    :return: None
+    """
+    report = {
+        "finished": datetime.now().isoformat(),
+        "dry_run": dry_run,
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "members": plan.members,
+        "create_claims": len(plan.create_claims),
+        "create_roles": len(plan.create_roles),
+        "attach_claims": len(plan.attach_claims),
+        "unchanged": plan.unchanged,
+        "failed": sum(outcome.startswith("failed") for outcome in results.values()),
+        "results": results,
+        "pruned": pruned,
+    }
+    with open(shard_file(report_file), "w") as file:
+        json.dump(report, file, indent=2)
+
+def merge_shard_reports(count: int) -> bool:
+    """
+    Merges the reports written by every shard into ``report_file``.
+
+    Totals are summed and the member and pruning outcomes are combined. The time each shard finished is kept
+    so reports left over from an earlier run can be spotted. Shards whose report is missing are
+    listed in the merged report and logged as errors.
+
+    :param count: The number of shards.
+    :type count: int
+    :return: True if every shard's report was found, False otherwise.
+    :rtype: bool
+    """
+    totals = ("members", "create_claims", "create_roles", "attach_claims", "unchanged", "failed")
+    merged = {"finished": datetime.now().isoformat(), "shard_count": count, "shards_finished": {},
+              "missing_shards": [], **{key: 0 for key in totals}, "results": {}, "pruned": None}
+    for index in range(count):
+        root, extension = os.path.splitext(report_file)
+        path = f"{root}_shard{index}of{count}{extension}"
+        try:
+            with open(path, "r") as file:
+                report = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read report of shard {index}: {e}")
+            merged["missing_shards"].append(index)
+            continue
+        merged["shards_finished"][index] = report.get("finished")
+        for key in totals:
+            merged[key] += report.get(key, 0)
+        merged["results"].update(report.get("results", {}))
+        if report.get("pruned"):
+            merged["pruned"] = merged["pruned"] or {"roles": {}, "claims": {}}
+            for kind in ("roles", "claims"):
+                merged["pruned"][kind].update(report["pruned"][kind])
+    with open(report_file, "w") as file:
+        json.dump(merged, file, indent=2)
+    logger.info(f"Merged {count - len(merged['missing_shards'])} of {count} shard reports: "
+                f"{merged['members']} members, {merged['create_claims']} claims created, "
+                f"{merged['create_roles']} roles created, {merged['attach_claims']} claims attached, "
+                f"{merged['failed']} failed")
+    return not merged["missing_shards"]
+
+def spawn_shards(count: int, resume: bool = False) -> bool:
+    """
+    Runs every shard as a separate local process and waits for all of them to finish.
+
+    :param count: The number of shards.
+    :type count: int
+    :param resume: If True, every shard is started with ``--resume``.
+    :type resume: bool
+    :return: True if every shard process exited successfully, False otherwise.
+    :rtype: bool
+    """
+    script = os.path.abspath(__file__)
+    extra_args = ["--resume"] if resume else []
+    processes = [
+        subprocess.Popen([sys.executable, script, "--shard-count", str(count), "--shard-index", str(index), *extra_args])
+        for index in range(count)
+    ]
+    logger.info(f"Started {count} shard processes")
+    exit_codes = [process.wait() for process in processes]
+    for index, exit_code in enumerate(exit_codes):
+        if exit_code != 0:
+            logger.error(f"Shard {index} exited with code {exit_code}")
+    return all(exit_code == 0 for exit_code in exit_codes)
+
 def clean_old_error_logs(days=log_retention_days):
     """
-    Deletes old error log files created prior to a specified number of days. This function searches
-    for log files in the current directory matching the naming pattern "error_log_*.log". Files
-    older than the cutoff date are deleted to free up space and maintain organization.
+    Deletes old provisioning log files created prior to a specified number of days. This function searches
+    for log files in the current directory matching the naming pattern "provisioning_log_*.log*", which
+    includes the files rolled over by size. Files older than the cutoff date are deleted to free up space
+    and maintain organization.
 
-    :param days: The number of days to retain error log files. Files older than the specified
+    :param days: The number of days to retain log files. Files older than the specified
         number of days will be removed.
     :type days: int
     :return: None
     """
     try:
         cutoff_date = datetime.now() - timedelta(days=days)
-        log_pattern = "error_log_*.log"
+        log_pattern = "provisioning_log_*.log*"
 
         for log_file in glob.glob(log_pattern):
             try:
@@ -83,78 +305,430 @@ def clean_old_error_logs(days=log_retention_days):
 
                 if file_time < cutoff_date:
                     os.remove(log_file)
-                    print(f"Deleted old error log: {log_file}")
+                    print(f"Deleted old log: {log_file}")
             except Exception as e:
                 print(f"Error deleting {log_file}: {e}")
     except Exception as e:
-        print(f"Error cleaning old error logs: {e}")
+        print(f"Error cleaning old logs: {e}")
 
 def get_logger() -> logging.Logger:
     """
-    Configures and returns a logger instance for the application. The logger is
-    configured with a console handler for all logs and a file handler for error
-    logs only. If the logger has existing handlers, no configuration is applied.
-    Older error logs are cleaned up before configuring new handlers.
+    Configures and returns a logger instance for the application. The logger only puts records
+    on a queue, and a background listener thread writes them to the console and to a daily log
+    file that rolls over when it reaches ``log_max_bytes``, so threads logging during the run
+    never wait on console or disk I/O. If the logger has existing handlers, no configuration is
+    applied. Older logs are cleaned up before configuring new handlers, and the listener is
+    stopped, flushing the queue, when the script exits.
 
     :return: A logging.Logger instance with appropriate handlers and configurations.
     :rtype: logging.Logger
     """
     logger = logging.getLogger(variables["MODULE_LOGGER_NAME"])
     if not logger.handlers:
-        # Clean old error logs before setting up new handler
-        clean_old_error_logs(days=30)
+        # Clean old logs before setting up new handler
+        clean_old_error_logs(days=log_retention_days)
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
 
         # Console handler for all logs
         console_handler = logging.StreamHandler()
-        console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s"))
-        logger.addHandler(console_handler)
+        console_handler.setFormatter(formatter)
 
-        # File handler for error logs only
+        # Daily file handler, rolled over by size
         date_str = datetime.now().strftime("%Y%m%d")
-        file_handler = logging.FileHandler(f"provisioning_log_{date_str}.log")
-        file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s"))
-        logger.addHandler(file_handler)
+        file_handler = RotatingFileHandler(shard_file(f"provisioning_log_{date_str}.log"), maxBytes=log_max_bytes,
+                                           backupCount=log_backup_count)
+        file_handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(log_queue))
 
         logger.setLevel(logging.INFO)
         logger.propagate = False
     return logger
 
+class RunMetrics:
+    """
+    Collects the timing and API-call metrics of a provisioning run.
+
+    Phases record their wall time. Every HTTP response received through the pooled sessions is
+    recorded against its endpoint (method, host and path with ids replaced by ``{id}``) with its
+    size and latency. At the end of the run the metrics are written as a JSON summary, and
+    optionally as a Prometheus textfile for the node exporter textfile collector.
+
+    :ivar started: Unix time at which the run started.
+    :type started: float
+    :ivar phases: Wall time in seconds of each phase, keyed by phase name.
+    :type phases: dict
+    :ivar endpoints: Call count, bytes received and latencies of each endpoint.
+    :type endpoints: dict
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def timed_iter(self, name: str, iterable):
+        # Times only the work done producing each item, not the work of the consumer
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase(name, time.perf_counter() - start)
+                return
+            self.add_phase(name, time.perf_counter() - start)
+            yield item
+
+    def record_response(self, resp, *args, **kwargs):
+        url = urllib.parse.urlsplit(resp.request.url)
+        path = re.sub(r"/(\d+|[0-9a-fA-F-]{36})(?=/|$)", "/{id}", url.path)
+        endpoint = f"{resp.request.method} {url.hostname}{path}"
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {"calls": 0, "bytes": 0, "errors": 0, "latencies": []})
+            stats["calls"] += 1
+            stats["bytes"] += len(resp.content or b"")
+            stats["errors"] += resp.status_code >= 400
+            stats["latencies"].append(resp.elapsed.total_seconds())
+
+    @staticmethod
+    def _percentile(values: list, percent: float) -> float:
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "duration_seconds": round(time.time() - self.started, 3),
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "endpoints": {
+                    endpoint: {
+                        "calls": stats["calls"],
+                        "bytes": stats["bytes"],
+                        "errors": stats["errors"],
+                        "latency_p50": round(self._percentile(stats["latencies"], 50), 4),
+                        "latency_p95": round(self._percentile(stats["latencies"], 95), 4),
+                        "latency_p99": round(self._percentile(stats["latencies"], 99), 4),
+                    }
+                    for endpoint, stats in self.endpoints.items()
+                },
+            }
+
+    def to_prometheus(self, summary: dict) -> str:
+        # Sharded runs label every series with their shard, so the textfiles of all the shards
+        # can sit in the same collector directory without exporting duplicate series
+        prefix = "auto_provision"
+        shard_labels = {"shard": str(shard_index)} if shard_count > 1 else {}
+
+        def series(name: str, value, **labels) -> str:
+            labels = {**labels, **shard_labels}
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            return f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}"
+
+        lines = [
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            series("last_run_timestamp_seconds", f"{self.started:.0f}"),
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            series("run_duration_seconds", summary["duration_seconds"]),
+            f"# TYPE {prefix}_phase_duration_seconds gauge",
+        ]
+        lines += [series("phase_duration_seconds", seconds, phase=name) for name, seconds in summary["phases"].items()]
+        for metric, key in (("api_calls", "calls"), ("api_bytes", "bytes"), ("api_errors", "errors")):
+            lines.append(f"# TYPE {prefix}_{metric} gauge")
+            lines += [series(metric, stats[key], endpoint=endpoint) for endpoint, stats in summary["endpoints"].items()]
+        lines.append(f"# TYPE {prefix}_api_latency_seconds summary")
+        for endpoint, stats in summary["endpoints"].items():
+            for quantile in ("50", "95", "99"):
+                lines.append(series("api_latency_seconds", stats[f"latency_p{quantile}"],
+                                    endpoint=endpoint, quantile=f"0.{quantile}"))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        summary = self.summary()
+        try:
+            with open(metrics_file, "w") as file:
+                json.dump(summary, file, indent=2)
+            if prometheus_textfile:
+                temp_file = f"{prometheus_textfile}.tmp"
+                with open(temp_file, "w") as file:
+                    file.write(self.to_prometheus(summary))
+                os.replace(temp_file, prometheus_textfile)
+        except OSError as e:
+            logger.error(f"Could not write run metrics: {e}")
+        logger.info(f"Run metrics: {json.dumps(summary['phases'])}")
+
+def create_session() -> requests.Session:
+    """
+    Creates a session whose connection pool is sized to the configured concurrency.
+
+    Connections are kept alive and reused for every request sent through the session, so the
+    TCP and TLS handshakes to each host are only paid once per pooled connection rather than
+    once per API call. Every response is recorded in the run metrics.
+
+    :return: A requests session with a pooled adapter mounted for http and https.
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    session.hooks["response"].append(metrics.record_response)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def log_pool_statistics(name: str, session: requests.Session):
+    """
+    Logs how many requests were sent and connections opened for each host reached by a session.
+
+    :param name: A label for the session used in the log lines.
+    :type name: str
+    :param session: The session whose connection pools are reported.
+    :type session: requests.Session
+    :return: None
+    """
+    reported = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in reported:
+            continue
+        reported.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            logger.info(f"{name} pool {pool.host}:{pool.port} - {pool.num_requests} requests over "
+                        f"{pool.num_connections} connections")
+
+class RateLimiter:
+    """
+    Adaptive token bucket limiting the request rate to one upstream service.
+
+    Requests take a token from the bucket before they are sent. When the upstream throttles a
+    request the rate is halved and every caller pauses for the ``Retry-After`` delay, and each
+    successful request raises the rate again by a small step until ``max_rate`` is reached.
+
+    :ivar name: Name of the upstream, used in log lines.
+    :type name: str
+    :ivar max_rate: Highest rate allowed, in requests per second.
+    :type max_rate: float
+    :ivar min_rate: Lowest rate the limiter backs off to, in requests per second.
+    :type min_rate: float
+    :ivar rate: Current rate, in requests per second.
+    :type rate: float
+    """
+    def __init__(self, name: str, max_rate: float, min_rate: float = 1.0):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self._burst = max(1.0, max_rate)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._blocked_until:
+                    self._tokens = min(self._burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._blocked_until - now
+            time.sleep(wait)
+
+    def throttled(self, delay: float):
+        """
+        Pauses every caller for ``delay`` seconds and halves the rate. Requests throttled while
+        a pause is already running only extend it, so a burst of throttled requests lowers the
+        rate once per pause instead of once per request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            lowered = now >= self._blocked_until
+            if lowered:
+                self.rate = max(self.min_rate, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, now + delay)
+            self._tokens = 0.0
+            self._updated = self._blocked_until
+            rate = self.rate
+        if lowered:
+            logger.warning(f"{self.name} throttled the request. Pausing {delay:.1f}s, rate lowered to {rate:.1f}/s")
+        else:
+            logger.warning(f"{self.name} throttled the request. Pausing {delay:.1f}s")
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+def get_retry_delay(resp, attempt: int) -> float:
+    """
+    Returns how long to wait before retrying a throttled request.
+
+    The ``Retry-After`` header is honoured when present, either as a number of seconds or as an
+    HTTP date. Otherwise an exponential backoff with full jitter is used. The delay never exceeds
+    ``max_backoff_seconds``.
+
+    :param resp: The throttled response.
+    :type resp: requests.Response
+    :param attempt: The number of attempts already made for the request, starting at 0.
+    :type attempt: int
+    :return: The delay in seconds.
+    :rtype: float
+    """
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(max_backoff_seconds, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(max_backoff_seconds, max(0.0, retry_at.timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(max_backoff_seconds, 2 ** attempt))
+
+def send_with_retry(limiter: RateLimiter, send, idempotent: bool = True):
+    """
+    Sends a request through a rate limiter, retrying it when the upstream throttles it.
+
+    Responses with status 429 are retried up to ``max_retries`` times after the delay returned
+    by get_retry_delay. Status 503 is retried the same way for idempotent requests only: a
+    gateway can answer 503 after the backend already made the change, so a request that creates
+    something is only sent again when the 503 carries a ``Retry-After`` header. The last response
+    is returned if every retry is throttled.
+
+    :param limiter: The rate limiter of the upstream service.
+    :type limiter: RateLimiter
+    :param send: A callable sending the request and returning the response.
+    :type send: Callable[[], requests.Response]
+    :param idempotent: False for requests that must not be repeated blindly, such as a POST
+        creating a claim or a role.
+    :type idempotent: bool
+    :return: The response object.
+    :rtype: requests.Response
+    """
+    attempt = 0
+    while True:
+        limiter.acquire()
+        resp = send()
+        retry = resp.status_code == 429 or (
+            resp.status_code == 503 and (idempotent or "Retry-After" in resp.headers))
+        if not retry or attempt >= max_retries:
+            if resp.status_code < 400:
+                limiter.succeeded()
+            return resp
+        limiter.throttled(get_retry_delay(resp, attempt))
+        attempt += 1
+
+class TokenProvider:
+    """
+    Caches an OAuth access token obtained with the client credentials grant.
+
+    The token is reused until shortly before the ``expires_in`` returned by the token endpoint,
+    then refreshed on the next request for it. The refresh is done under a lock so concurrent
+    callers only cause a single token request, and the Keyfactor header dictionaries for each
+    API version are built once per token.
+
+    :ivar token_url: The token endpoint of the identity provider.
+    :type token_url: str
+    :ivar data: The form data posted to the token endpoint.
+    :type data: dict
+    :ivar refresh_margin: Seconds before expiry at which the token is refreshed.
+    :type refresh_margin: int
+    :ivar session: The session used to reach the token endpoint.
+    :type session: requests.Session
+    """
+    def __init__(self, token_url: str, data: dict, refresh_margin: int = 120, session: requests.Session = None):
+        self.token_url = token_url
+        self.data = data
+        self.refresh_margin = refresh_margin
+        self.session = session or create_session()
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0.0
+        self._headers = {}
+
+    def _valid(self) -> bool:
+        return self._access_token is not None and time.monotonic() < self._expires_at
+
+    def get_token(self) -> str:
+        if self._valid():
+            return self._access_token
+        with self._lock:
+            if not self._valid():
+                token_resp = self.session.post(
+                    self.token_url,
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                    data=self.data,
+                    timeout=30,
+                )
+                token_resp.raise_for_status()
+                token_data = token_resp.json()
+                expires_in = int(token_data.get("expires_in", 3600))
+                self._headers = {}
+                self._access_token = token_data["access_token"]
+                self._expires_at = time.monotonic() + max(expires_in - self.refresh_margin, expires_in / 2)
+                logger.debug(f"Fetched new access token from {self.token_url}, expires in {expires_in}s")
+            return self._access_token
+
+    def invalidate(self):
+        with self._lock:
+            self._access_token = None
+            self._headers = {}
+
+    def get_headers(self, header_version: int) -> dict:
+        access_token = self.get_token()
+        headers = self._headers.get(header_version)
+        if headers is None or headers["Authorization"] != f"Bearer {access_token}":
+            headers = {
+                "content-type": "application/json",
+                "accept": "text/plain",
+                "x-keyfactor-requested-with": "APIClient",
+                "x-keyfactor-api-version": f"{header_version}.0",
+                "Authorization": f"Bearer {access_token}",
+            }
+            self._headers[header_version] = headers
+        return dict(headers)
+
 def create_auth_headers(header_version: int):
     """
-    Creates authentication headers necessary for API requests by retrieving an access token
-    using the specified client credentials and constructing a header with required fields.
+    Creates authentication headers necessary for API requests using the cached Keyfactor access
+    token, requesting a new token only when the cached one is about to expire.
 
     :param header_version: An integer representing the API version to be included in the headers.
     :return: A dictionary containing the authentication headers needed for API access.
     """
-    token_resp = requests.post(
-        variables["token_url"],
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-        data={
-            "grant_type": "client_credentials",
-            "client_id": variables["client_id"],
-            "client_secret": variables["client_secret"],
-            **({"scope": variables["scope"]} if variables.get("scope") else {}),
-            **({"audience": variables["audience"]} if variables.get("audience") else {}),
-        },
-        timeout=30,
-    )
-    token_resp.raise_for_status()
-    access_token = token_resp.json()["access_token"]
-    return {
-        "content-type": "application/json",
-        "accept": "text/plain",
-        "x-keyfactor-requested-with": "APIClient",
-        "x-keyfactor-api-version": f"{header_version}.0",
-        "Authorization": f"Bearer {access_token}",
-    }
+    return token_provider.get_headers(header_version)
 
 class KeyfactorClient:
     """
     Client for interacting with the Keyfactor API.
 
     This class provides methods for making HTTP requests to the Keyfactor API,
-    including GET, POST, and PUT requests. It manages the session state and
+    including GET, POST, PUT and DELETE requests. It manages the session state and
     handles the construction of the full URLs for API endpoints. The class is
     intended to streamline communication with the Keyfactor service by providing
     a centralized client instance.
@@ -162,105 +736,538 @@ class KeyfactorClient:
     :ivar vars: Dictionary of configuration variables required for API communication.
                 It should include the base URL under the key 'keyfactordns'.
     :type vars: dict
+    :ivar session: Pooled session shared by every request of the run.
+    :type session: requests.Session
     """
-    def __init__(self, variables: dict):
+    def __init__(self, variables: dict, session: requests.Session = None):
         self.vars = variables
-        self.session = requests.Session()
+        self.session = session or create_session()
 
     # Helper to build full URL from base and endpoint
     def _build_url(self, endpoint: str) -> str:
         base = self.vars["keyfactordns"].rstrip("/")
         return f"{base}/{endpoint.lstrip('/')}"
 
-    def get(self, endpoint: str, header_version: int = 1):
-        # Refresh API version header per-call
-        headers = create_auth_headers(header_version)
+    # Sends a request, retrying once with a fresh token if the cached one was rejected
+    def _request(self, method: str, endpoint: str, header_version: int, body: dict = None):
         url = self._build_url(endpoint)
-        logger.debug(f"GET {url}")
-        resp = self.session.get(url, headers=headers, timeout=60, proxies=proxies, verify=False)
+        data = json.dumps(body) if body is not None else None
+        logger.debug(f"{method} {url}")
+
+        def send():
+            return self.session.request(method, url, headers=create_auth_headers(header_version), data=data,
+                                        timeout=60, proxies=proxies, verify=False)
+
+        idempotent = method != "POST"
+        resp = send_with_retry(keyfactor_limiter, send, idempotent)
+        if resp.status_code == 401:
+            token_provider.invalidate()
+            resp = send_with_retry(keyfactor_limiter, send, idempotent)
         resp.raise_for_status()
         return resp
 
+    def get(self, endpoint: str, header_version: int = 1):
+        return self._request("GET", endpoint, header_version)
+
     def post(self, endpoint: str, body: dict, header_version: int = 1):
-        headers = create_auth_headers(header_version)
-        url = self._build_url(endpoint)
-        resp = self.session.post(url, headers=headers, data=json.dumps(body), timeout=60, verify=False)
-        resp.raise_for_status()
-        return resp
+        return self._request("POST", endpoint, header_version, body)
 
     def put(self, endpoint: str, body: dict, header_version: int = 1):
-        headers = create_auth_headers(header_version)
-        url = self._build_url(endpoint)
-        resp = self.session.put(url, headers=headers, data=json.dumps(body), timeout=60, verify=False)
-        resp.raise_for_status()
-        return resp
+        return self._request("PUT", endpoint, header_version, body)
+
+    def delete(self, endpoint: str, header_version: int = 1):
+        return self._request("DELETE", endpoint, header_version)
 
-def get_graph_transitive_members(group_name: str) -> list:
+def graph_get(url: str):
     """
-    Fetch the transitive members (sub-groups) of a specified group from Microsoft Entra using the Microsoft Graph API.
-    This function retrieves all nested group members associated with the provided group name.
+    Sends a GET request to Microsoft Graph with the cached Graph access token.
 
-    Errors during the API request or response handling are logged, and an empty list is returned in case of an
-    error.
+    :param url: The full Graph URL to request.
+    :type url: str
+    :return: The response object.
+    :rtype: requests.Response
 
-    :param group_name: Name of the group to fetch transitive members for
-    :type group_name: str
-    :return: List of transitive group members, specifically groups, found under the given group
-    :rtype: list
+    :raises requests.exceptions.RequestException: If the request fails.
     """
-    try:
-        token_resp = requests.post(
-            variables["entra_token_url"],
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data={
-                "grant_type": "client_credentials",
-                "client_id": variables["entra_client_id"],
-                "client_secret": variables["entra_client_secret"],
-                "scope": "https://graph.microsoft.com/.default"
-            },
-            timeout=30,
-        )
-        token_resp.raise_for_status()
-        access_token = token_resp.json()["access_token"]
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-        search_url = f"https://graph.microsoft.com/v1.0/groups?$filter=displayName eq '{group_name}'"
-        search_resp = requests.get(search_url, headers=headers, timeout=30, proxies=proxies, verify=False)
-        search_resp.raise_for_status()
-        search_data = search_resp.json()
-        if not search_data.get("value"):
+    headers = {
+        "Authorization": f"Bearer {graph_token_provider.get_token()}",
+        "Content-Type": "application/json",
+        "ConsistencyLevel": "eventual"
+    }
+    resp = send_with_retry(
+        graph_limiter, lambda: graph_session.get(url, headers=headers, timeout=30, proxies=proxies, verify=False))
+    resp.raise_for_status()
+    return resp
+
+def graph_post(url: str, body: dict):
+    """
+    Sends a POST request with a JSON body to Microsoft Graph with the cached Graph access token.
+    Only read-only POSTs (``$batch`` of GETs, ``checkMemberGroups``) are sent, so they are retried
+    like GET requests.
+
+    :param url: The full Graph URL to request.
+    :type url: str
+    :param body: The JSON body of the request.
+    :type body: dict
+    :return: The response object.
+    :rtype: requests.Response
+
+    :raises requests.exceptions.RequestException: If the request fails.
+    """
+    headers = {
+        "Authorization": f"Bearer {graph_token_provider.get_token()}",
+        "Content-Type": "application/json"
+    }
+    resp = send_with_retry(graph_limiter, lambda: graph_session.post(
+        url, headers=headers, data=json.dumps(body), timeout=30, proxies=proxies, verify=False))
+    resp.raise_for_status()
+    return resp
+
+GRAPH_BATCH_LIMIT = 20  # sub-requests allowed in one Graph JSON batch
+
+def graph_batch(urls: dict) -> dict:
+    """
+    Sends GET requests to Microsoft Graph in JSON ``$batch`` requests of up to 20 sub-requests.
+
+    Every batch is sent with graph_post, so it uses the cached Graph token and the Graph rate
+    limiter. Sub-requests throttled with status 429 or 503 are sent again in a later batch, up
+    to ``max_retries`` times, after pausing for the longest ``Retry-After`` delay of the batch.
+
+    :param urls: The URLs to request, relative to the Graph version root, keyed by an id unique
+        within the call.
+    :type urls: dict
+    :return: The sub-responses, each with ``status``, ``headers`` and ``body``, keyed by the ids
+        of ``urls``.
+    :rtype: dict
+
+    :raises requests.exceptions.RequestException: If a batch request fails.
+    """
+    responses = {}
+    pending = dict(urls)
+    attempt = 0
+    while pending:
+        ids = list(pending)
+        throttled = {}
+        delay = 0.0
+        for start in range(0, len(ids), GRAPH_BATCH_LIMIT):
+            body = {"requests": [{"id": request_id, "method": "GET", "url": pending[request_id]}
+                                 for request_id in ids[start:start + GRAPH_BATCH_LIMIT]]}
+            for response in graph_post("https://graph.microsoft.com/v1.0/$batch", body).json().get("responses", []):
+                if response.get("status") in (429, 503) and attempt < max_retries:
+                    throttled[response["id"]] = pending[response["id"]]
+                    headers = SimpleNamespace(headers=CaseInsensitiveDict(response.get("headers") or {}))
+                    delay = max(delay, get_retry_delay(headers, attempt))
+                else:
+                    responses[response["id"]] = response
+        if throttled:
+            graph_limiter.throttled(delay)
+            attempt += 1
+        pending = throttled
+    return responses
+
+def get_source_groups() -> list:
+    """
+    Returns the names of the Entra parent groups to provision from.
+
+    ``entra_all_users_group`` holds either the name of a single parent group or a list of names.
+    Names listed twice are only kept once.
+
+    :return: The parent group names, in the configured order.
+    :rtype: list[str]
+    """
+    groups = variables["entra_all_users_group"]
+    if isinstance(groups, str):
+        groups = [groups]
+    return list(dict.fromkeys(groups))
+
+def get_graph_group_ids(group_names: list) -> dict:
+    """
+    Looks up the ids of Entra groups by their display names, with one ``$batch`` request for
+    every 20 names.
+
+    :param group_names: Display names of the groups.
+    :type group_names: list[str]
+    :return: The group ids keyed by display name. Groups that were not found are left out.
+    :rtype: dict
+
+    :raises requests.exceptions.RequestException: If a batch request fails.
+    """
+    urls = {}
+    for index, group_name in enumerate(group_names):
+        escaped_name = group_name.replace("'", "''")
+        group_filter = urllib.parse.quote(f"displayName eq '{escaped_name}'")
+        urls[str(index)] = f"/groups?$filter={group_filter}&$select=id"
+    responses = graph_batch(urls)
+    group_ids = {}
+    for index, group_name in enumerate(group_names):
+        response = responses.get(str(index)) or {}
+        found = (response.get("body") or {}).get("value") if response.get("status") == 200 else None
+        if found:
+            group_ids[group_name] = found[0]["id"]
+        elif response.get("status", 200) != 200:
+            logger.warning(f"Group '{group_name}' could not be looked up: status {response.get('status')}")
+        else:
             logger.warning(f"Group '{group_name}' not found")
-            return []
-        group_id = search_data["value"][0]["id"]
-        groups = []
-        members_url = f"https://graph.microsoft.com/v1.0/groups/{group_id}/transitiveMembers"
-        while members_url:
-            members_resp = requests.get(members_url, headers=headers, timeout=30, proxies=proxies, verify=False)
-            logger.debug(
-                f"GET {members_url} - {members_resp.status_code} - {members_resp.text}"
-            )
-            members_resp.raise_for_status()
-            members_data = members_resp.json()
-            group_members = [m for m in members_data.get("value", []) if
-                             m.get("@odata.type") == "#microsoft.graph.group"]
-            groups.extend(group_members)
-            members_url = members_data.get("@odata.nextLink")
-        logger.info(f"Total transitive group members retrieved: {len(groups)}")
-        return groups
+    return group_ids
+
+def iter_graph_transitive_groups(group_id: str):
+    """
+    Yields the groups nested under a group, page by page.
+
+    Only groups are requested, through the ``microsoft.graph.group`` type-cast segment, with ``$select``
+    limited to the fields used during reconciliation and the largest page size Graph allows.
+
+    :param group_id: Id of the group to fetch transitive members for.
+    :type group_id: str
+    :return: Generator of group objects with ``id`` and ``displayName``.
+    :rtype: Iterator[dict]
+
+    :raises requests.exceptions.RequestException: If a page request fails.
+    """
+    members_url = (f"https://graph.microsoft.com/v1.0/groups/{group_id}/transitiveMembers/microsoft.graph.group"
+                   f"?$select=id,displayName&$top=999")
+    while members_url:
+        members_resp = graph_get(members_url)
+        members_data = members_resp.json()
+        group_members = members_data.get("value", [])
+        logger.debug(f"GET {members_url} - {members_resp.status_code} - {len(group_members)} groups")
+        yield from group_members
+        members_url = members_data.get("@odata.nextLink")
+
+def get_graph_transitive_members(group_names: list):
+    """
+    Fetch the transitive members (sub-groups) of the specified parent groups from Microsoft Entra using the Microsoft Graph API.
+    This function yields all nested group members associated with the provided group names.
+
+    The parent group ids are resolved together with get_graph_group_ids. Groups are yielded page by page as they
+    arrive, so the full membership is never held in memory by this function, and a group nested under several
+    parent groups is only yielded once. Errors during the API request or response handling are logged, and
+    iteration stops in case of an error. The generator returns True when every parent group was found and every
+    page was retrieved, and False otherwise.
+
+    :param group_names: Names of the parent groups to fetch transitive members for
+    :type group_names: list[str]
+    :return: Generator of transitive group members, specifically groups, found under the given groups
+    :rtype: Generator[dict, None, bool]
+    """
+    try:
+        group_ids = get_graph_group_ids(group_names)
+        seen = set()
+        for group_id in group_ids.values():
+            for group in iter_graph_transitive_groups(group_id):
+                if group["id"] not in seen:
+                    seen.add(group["id"])
+                    yield group
+        logger.info(f"Total transitive group members retrieved: {len(seen)}")
+        return len(group_ids) == len(group_names)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error fetching transitive group members from Entra for groups {', '.join(group_names)}: {e}")
+        return False
+
+def get_graph_delta_link():
+    """
+    Requests a Graph delta link for groups that starts from the current point in time, without
+    enumerating the groups of the tenant.
+
+    :return: The delta link, or None if it could not be retrieved.
+    :rtype: str | None
+    """
+    url = "https://graph.microsoft.com/v1.0/groups/delta?$select=id,displayName,members&$deltatoken=latest"
+    try:
+        while url:
+            data = graph_get(url).json()
+            if "@odata.deltaLink" in data:
+                return data["@odata.deltaLink"]
+            url = data.get("@odata.nextLink")
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching transitive group members from Entra for group '{group_name}': {e}")
-        return []
+        logger.error(f"Error retrieving Graph delta link: {e}")
+    return None
+
+def get_graph_changed_members(group_names: list, delta_link: str):
+    """
+    Yields the groups under the parent groups that were added or changed since a Graph delta link.
+
+    The delta query reports groups that were created or renamed and groups whose direct members
+    changed. Every reported group, and every group added as a member, is checked for transitive
+    membership of the parent groups with ``checkMemberGroups``. Groups that belong to a parent are
+    yielded together with the groups nested under them, since a group moved into a parent brings
+    its whole subtree with it.
+
+    :param group_names: Names of the parent groups.
+    :type group_names: list[str]
+    :param delta_link: The delta link saved by the previous run.
+    :type delta_link: str
+    :return: Generator of changed groups. The generator returns the new delta link when every change
+        was processed, or None if the delta could not be read and a full sync is required.
+    :rtype: Generator[dict, None, str | None]
+    """
+    try:
+        group_ids = get_graph_group_ids(group_names)
+        if len(group_ids) != len(group_names):
+            return None
+        parent_ids = list(group_ids.values())
+        names = {}
+        url = delta_link
+        new_delta_link = None
+        while url:
+            data = graph_get(url).json()
+            for group in data.get("value", []):
+                if "@removed" in group:
+                    continue
+                names.setdefault(group["id"], group.get("displayName"))
+                for member in group.get("members@delta", []):
+                    if "@removed" not in member and member.get("@odata.type") == "#microsoft.graph.group":
+                        names.setdefault(member["id"], None)
+            url = data.get("@odata.nextLink")
+            new_delta_link = data.get("@odata.deltaLink", new_delta_link)
+        for parent_id in parent_ids:
+            names.pop(parent_id, None)
+        logger.info(f"Graph delta reported {len(names)} changed groups")
+        seen = set()
+        for changed_id, display_name in names.items():
+            if changed_id in seen:
+                continue
+            if not any(
+                    graph_post(f"https://graph.microsoft.com/v1.0/groups/{changed_id}/checkMemberGroups",
+                               {"groupIds": parent_ids[start:start + GRAPH_BATCH_LIMIT]}).json().get("value")
+                    for start in range(0, len(parent_ids), GRAPH_BATCH_LIMIT)):
+                continue
+            if display_name is None:
+                display_name = graph_get(
+                    f"https://graph.microsoft.com/v1.0/groups/{changed_id}?$select=id,displayName").json()["displayName"]
+            seen.add(changed_id)
+            yield {"id": changed_id, "displayName": display_name}
+            for nested in iter_graph_transitive_groups(changed_id):
+                if nested["id"] not in seen:
+                    seen.add(nested["id"])
+                    yield nested
+        return new_delta_link
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error reading Graph delta for groups {', '.join(group_names)}: {e}")
+        return None
+
+def load_delta_state(group_names: list):
+    """
+    Loads the incremental sync state saved by the previous run.
+
+    The state is discarded, forcing a full sync, when the file is missing or cannot be parsed,
+    when it was written for other parent groups, or when the last full sync is older than
+    ``full_resync_hours``.
+
+    :param group_names: Names of the parent groups being provisioned.
+    :type group_names: list[str]
+    :return: The saved state, or None if a full sync is required.
+    :rtype: dict | None
+    """
+    try:
+        with open(delta_state_file, "r") as state_file:
+            state = json.load(state_file)
+        last_full_sync = datetime.fromisoformat(state["last_full_sync"])
+        if state["group_name"] != group_names or not state["delta_link"]:
+            logger.info("Delta state does not match the configured groups. Running a full sync.")
+            return None
+        if datetime.now() - last_full_sync > timedelta(hours=full_resync_hours):
+            logger.info(f"Last full sync is older than {full_resync_hours} hours. Running a full sync.")
+            return None
+        return state
+    except FileNotFoundError:
+        logger.info("No delta state found. Running a full sync.")
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Delta state file {delta_state_file} is invalid ({e}). Running a full sync.")
+    return None
+
+def save_delta_state(state: dict):
+    """
+    Writes the incremental sync state, replacing the previous file atomically.
+
+    :param state: The state to save.
+    :type state: dict
+    :return: None
+    """
+    temp_file = f"{delta_state_file}.tmp"
+    with open(temp_file, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_file, delta_state_file)
+
+def get_entra_members(group_names: list, state: dict):
+    """
+    Yields the Entra groups to reconcile for this run.
+
+    In incremental mode with a valid saved state only the groups changed since the saved delta link
+    are yielded, falling back to a full sync if the delta link was rejected. Otherwise the full transitive membership is enumerated, after taking a fresh delta
+    link so that changes made during the run are picked up by the next one. ``state`` is updated
+    with the delta link to save only once every group was retrieved, and its ``enumerated`` flag
+    is set when the full membership of every parent group was read.
+
+    :param group_names: Names of the parent groups.
+    :type group_names: list[str]
+    :param state: The saved state from load_delta_state, or an empty dict for a full sync.
+        It is updated in place.
+    :type state: dict
+    :return: Generator of group objects.
+    :rtype: Iterator[dict]
+    """
+    if state.get("delta_link"):
+        logger.info(f"Incremental sync of {', '.join(group_names)} since {state['last_sync']}")
+        new_delta_link = yield from get_graph_changed_members(group_names, state["delta_link"])
+        if new_delta_link:
+            state.update(delta_link=new_delta_link, last_sync=datetime.now().isoformat(), complete=True)
+            return
+        logger.warning("Graph delta could not be read. Falling back to a full sync.")
+        state.clear()
+    delta_link = get_graph_delta_link() if incremental else None
+    complete = yield from get_graph_transitive_members(group_names)
+    state["enumerated"] = complete
+    if complete and delta_link:
+        now = datetime.now().isoformat()
+        state.update(group_name=group_names, delta_link=delta_link, last_full_sync=now, last_sync=now, complete=True)
+
+def get_paged_collection(client, base_path: str, header_version: int = 1, convert=None):
+    """
+    Fetches every page of a Keyfactor collection endpoint.
+
+    The first page is requested to read the ``x-total-count`` header, then the remaining pages
+    are requested concurrently, up to ``max_workers`` at a time. Pages are combined in order and
+    the number of items collected is checked against the header. Items created or deleted while
+    the pages are read shift the offset pages, so on a mismatch the whole listing is read again,
+    up to ``max_retries`` times, rather than planning against an incomplete list.
+
+    :param client: The KeyfactorClient used to send the requests.
+    :type client: KeyfactorClient
+    :param base_path: The endpoint and query string, without paging parameters.
+    :type base_path: str
+    :param header_version: The Keyfactor API version used for every page.
+    :type header_version: int
+    :param convert: Optional function applied to every item as its page arrives, so only the
+        converted items are kept rather than the full JSON of every page.
+    :type convert: callable | None
+    :return: The combined list of items, or ``False`` if the ``x-total-count`` header is missing
+        or the number of items never matched it.
+    :rtype: list | bool
+
+    :raises requests.exceptions.RequestException: If any page request fails.
+    """
+    separator = "&" if "?" in base_path else "?"
+    page_path = f"{base_path}{separator}ReturnLimit={page_size}&PageReturned={{page}}"
+    convert = convert or (lambda item: item)
+    for attempt in range(max_retries + 1):
+        response = client.get(page_path.format(page=1), header_version=header_version)
+        total_count_header = response.headers.get("x-total-count")
+        if total_count_header is None:
+            return False
+        total_count = int(total_count_header)
+        items = [convert(item) for item in response.json()]
+        pages = math.ceil(total_count / page_size)
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                responses = executor.map(
+                    lambda page: client.get(page_path.format(page=page), header_version=header_version),
+                    range(2, pages + 1),
+                )
+                for resp in responses:
+                    items.extend(convert(item) for item in resp.json())
+        if len(items) == total_count:
+            return items
+        logger.warning(f"{base_path}: expected {total_count} items but retrieved {len(items)}. "
+                       f"Reading the listing again (attempt {attempt + 1} of {max_retries + 1})")
+    logger.error(f"{base_path}: the listing kept changing while it was read")
+    return False
+
+def intern_string(value):
+    """
+    Interns a string so equal values read from different API responses share one object.
+
+    :param value: The value to intern. Values that are not strings are returned unchanged.
+    :return: The interned string, or ``value`` itself.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+class ClaimRecord:
+    """
+    Compact in-memory form of a Keyfactor claim.
+
+    Only the fields needed by reconciliation, create_role and build_claim are kept, and the
+    strings are interned, so the claim types and authentication schemes shared by every claim
+    are stored once instead of once per claim.
+
+    :ivar id: The Id of the claim.
+    :type id: int
+    :ivar claim_type: The claim type, as returned by the Keyfactor API.
+    :type claim_type: str | int
+    :ivar claim_value: The value of the claim, which is the name of the Entra group.
+    :type claim_value: str
+    :ivar scheme: The authentication scheme of the claim's identity provider.
+    :type scheme: str
+    :ivar description: The description of the claim.
+    :type description: str
+    """
+    __slots__ = ("id", "claim_type", "claim_value", "scheme", "description")
+
+    def __init__(self, id, claim_type, claim_value, scheme, description):
+        self.id = id
+        self.claim_type = intern_string(claim_type)
+        self.claim_value = intern_string(claim_value)
+        self.scheme = intern_string(scheme)
+        self.description = intern_string(description)
+
+    @classmethod
+    def from_api(cls, claim: dict):
+        provider = claim.get("Provider") or {}
+        return cls(claim.get("Id"), claim.get("ClaimType"), claim.get("ClaimValue"),
+                   provider.get("AuthenticationScheme", claim.get("ProviderAuthenticationScheme")),
+                   claim.get("Description"))
+
+    def to_dict(self) -> dict:
+        return {
+            "Id": self.id,
+            "ClaimType": self.claim_type,
+            "ClaimValue": self.claim_value,
+            "ProviderAuthenticationScheme": self.scheme,
+            "Description": self.description,
+        }
+
+    def to_row(self) -> list:
+        return [self.id, self.claim_type, self.claim_value, self.scheme, self.description]
+
+class RoleRecord:
+    """
+    Compact in-memory form of a Keyfactor role.
+
+    Only the Id, the name and the values of the role's claims are kept. The full payload of a
+    role, which the update request needs, is loaded by Id with get_role_details only for the
+    roles that are updated.
+
+    :ivar id: The Id of the role.
+    :type id: int
+    :ivar name: The name of the role.
+    :type name: str
+    :ivar claim_values: The values of the claims attached to the role, or None until they are
+        known when the role listing does not include them.
+    :type claim_values: tuple | None
+    """
+    __slots__ = ("id", "name", "claim_values")
+
+    def __init__(self, id, name, claim_values=None):
+        self.id = id
+        self.name = intern_string(name)
+        self.claim_values = None if claim_values is None else tuple(intern_string(v) for v in claim_values)
+
+    @classmethod
+    def from_api(cls, role: dict):
+        claims = role.get("Claims")
+        return cls(role.get("Id"), role.get("Name"),
+                   None if claims is None else [claim.get("ClaimValue") for claim in claims])
+
+    def to_row(self) -> list:
+        return [self.id, self.name, None if self.claim_values is None else list(self.claim_values)]
 
 def get_roles():
     """
     Fetches all roles from the Keyfactor API.
 
-    This function retrieves roles in batches of 100 and combines them into a single
-    list if the total number of roles exceeds 100. The number of pages required to
-    retrieve all roles is calculated based on the `x-total-count` header from the
-    initial API response.
+    The pages of the role listing are retrieved with get_paged_collection, which requests the
+    pages after the first one concurrently and checks the total against the ``x-total-count``
+    header of the first response. Each role is kept as a compact RoleRecord.
 
     :return: A list of roles if the API call is successful and the roles are fetched.
              Returns ``False`` if the `x-total-count` header is missing or if there
@@ -271,22 +1278,10 @@ def get_roles():
          with the HTTP request to the Keyfactor API.
     """
     try:
-        client = KeyfactorClient(variables)
-        base_path = f"Security/Roles?returnlimit=100"
-        response = client.get(base_path, header_version=2)
-        total_count_header = response.headers.get("x-total-count")
-        if total_count_header is None:
-            return False
-        total_count = int(total_count_header)
-        logger.info(f"Total count of roles to process: {total_count}")
-        roles = response.json()
-        if total_count <= 100:
-            return roles
-        pages = math.ceil(total_count / 100)
-        for page in range(2, pages + 1):
-            f"{base_path}&PageReturned={page}"
-            resp = client.get(base_path, header_version=2)
-            roles.extend(resp.json())
+        client = keyfactor_client
+        roles = get_paged_collection(client, "Security/Roles", header_version=2, convert=RoleRecord.from_api)
+        if roles is not False:
+            logger.info(f"Total count of roles to process: {len(roles)}")
         return roles
     except requests.exceptions.RequestException as e:
         logger.error(msg="Coult not get roles from Keyfactor API")
@@ -298,10 +1293,10 @@ def get_claims():
     Fetches claim data from the Keyfactor API.
 
     This function communicates with the Keyfactor API using the KeyfactorClient to
-    retrieve the claims available. It employs pagination if the total number of
-    claims exceeds the specified page size (100). Logs the process and total count
-    of claims retrieved. If an exception occurs during the request, the function
-    logs the error details and returns ``False``.
+    retrieve the OAuthRole claims available. The pages of the listing are retrieved with
+    get_paged_collection, and each claim is kept as a compact ClaimRecord. Logs the total count
+    of claims retrieved. If an exception occurs
+    during the request, the function logs the error details and returns ``False``.
 
     :return: A list of claims retrieved from the API or ``False`` if the operation
              fails.
@@ -310,22 +1305,11 @@ def get_claims():
     :raises requests.exceptions.RequestException: If an HTTP request to Keyfactor API fails.
     """
     try:
-        client = KeyfactorClient(variables)
-        base_path = f"Security/Claims?QueryString=ClaimType%20-eq%20%224%22&ReturnLimit=100"
-        response = client.get(base_path, header_version=1,)
-        total_count_header = response.headers.get("x-total-count")
-        if total_count_header is None:
-            return False
-        total_count = int(total_count_header)
-        logger.info(f"Total count of claims to process: {total_count}")
-        claims = response.json()
-        if total_count <= 100:
-            return claims
-        pages = math.ceil(total_count / 100)
-        for page in range(2, pages + 1):
-            f"{base_path}&PageReturned={page}"
-            resp = client.get(base_path, header_version=2)
-            claims.extend(resp.json())
+        client = keyfactor_client
+        base_path = f"Security/Claims?QueryString=ClaimType%20-eq%20%224%22"
+        claims = get_paged_collection(client, base_path, header_version=1, convert=ClaimRecord.from_api)
+        if claims is not False:
+            logger.info(f"Total count of claims to process: {len(claims)}")
         return claims
     except requests.exceptions.RequestException as e:
         logger.error(msg="Coult not get claims from Keyfactor API")
@@ -353,7 +1337,7 @@ def create_claim(name, dry_run=False):
     if not should_create(name, dry_run):
         return
     try:
-        client = KeyfactorClient(variables)
+        client = keyfactor_client
         data = {
             "ClaimType": "OAuthRole",
             "ClaimValue": name,
@@ -367,37 +1351,62 @@ def create_claim(name, dry_run=False):
         logger.error(msg=f"creating claim: {e}")
         return False
 
+def prefetch_permission_sets():
+    """
+    Loads every permission set from the Keyfactor system into the permission set cache with one
+    paged listing, so the roles created during the run resolve their permission set locally.
+
+    :return: The number of permission sets cached, or False if the listing failed.
+    :rtype: int | bool
+    """
+    try:
+        permission_sets = get_paged_collection(keyfactor_client, "PermissionSets", header_version=1)
+    except requests.exceptions.RequestException as e:
+        logger.error(msg=f"prefetch permission sets: {e}")
+        return False
+    if permission_sets is False:
+        return False
+    fetched_at = time.monotonic()
+    with permission_set_lock:
+        for permission_set in permission_sets:
+            permission_set_cache[permission_set.get('Name')] = (permission_set.get('Id'), fetched_at)
+    return len(permission_sets)
+
 def get_permission_set(name):
     """
     Retrieves the ID of a permission set by its name from the Keyfactor system.
 
-    The function connects to the KeyfactorClient and queries for the permission
-    set specified by the given name. If the permission set exists and matches the
-    given name, its ID will be returned. If the permission set cannot be found,
-    or if any error occurs during the process, the function returns False.
+    Results are kept in a run-scoped cache, so each permission set is only looked up once per
+    run, or once per ``permission_set_ttl`` seconds when a TTL is configured. On a cache miss the
+    function queries for the permission set specified by the given name. If the permission set
+    cannot be found, or if any error occurs during the process, the function returns False.
 
     :param name: The name of the permission set to retrieve.
     :type name: str
     :return: The ID of the permission set if found, or False otherwise.
     :rtype: int or bool
     """
-    try:
-        client = KeyfactorClient(variables)
-        base_path = f"PermissionSets?QueryString=Name%20-eq%20%22{name}%22"
-        response = client.get(base_path, header_version=1)
-        total_count_header = response.headers.get("x-total-count")
-        if total_count_header is None:
-            return False
-        data = response.json()
-        for set in data:
-            if set.get('Name') == name:
-                return set.get('Id')
-            else:
+    with permission_set_lock:
+        cached = permission_set_cache.get(name)
+        if cached and (not permission_set_ttl or time.monotonic() - cached[1] < permission_set_ttl):
+            return cached[0]
+        try:
+            client = keyfactor_client
+            base_path = f"PermissionSets?QueryString=Name%20-eq%20%22{name}%22"
+            response = client.get(base_path, header_version=1)
+            total_count_header = response.headers.get("x-total-count")
+            if total_count_header is None:
                 return False
-    except requests.exceptions.RequestException as e:
-        logger.error(msg=f"Could not get permission set for: {name}")
-        logger.error(msg=f"get permission set: {e}")
-        return False
+            data = response.json()
+            permission_set_id = next((set.get('Id') for set in data if set.get('Name') == name), None)
+            if permission_set_id is None:
+                return False
+            permission_set_cache[name] = (permission_set_id, time.monotonic())
+            return permission_set_id
+        except requests.exceptions.RequestException as e:
+            logger.error(msg=f"Could not get permission set for: {name}")
+            logger.error(msg=f"get permission set: {e}")
+            return False
 
 def create_role(name, claim, dry_run=False):
     """
@@ -408,9 +1417,8 @@ def create_role(name, claim, dry_run=False):
 
     :param name: The name of the role to be created
     :type name: str
-    :param claim: A dictionary containing claim details such as `ClaimValue`, `Provider`
-        information, and `Description` of the claim
-    :type claim: dict
+    :param claim: The claim to attach to the role
+    :type claim: ClaimRecord
     :param dry_run: A boolean flag that, if set to True, ensures no changes are made in the
         actual system. Defaults to False
     :type dry_run: bool
@@ -422,7 +1430,7 @@ def create_role(name, claim, dry_run=False):
         return
 
     try:
-        client = KeyfactorClient(variables)
+        client = keyfactor_client
         data = {
             "Name": name,
             "Description": name,
@@ -434,9 +1442,9 @@ def create_role(name, claim, dry_run=False):
             "Claims": [
                 {
                     "ClaimType": 4,
-                    "ClaimValue": claim['ClaimValue'],
-                    "ProviderAuthenticationScheme": claim['Provider']['AuthenticationScheme'],
-                    "Description": claim['Description']
+                    "ClaimValue": claim.claim_value,
+                    "ProviderAuthenticationScheme": claim.scheme,
+                    "Description": claim.description
                 }
             ]
         }
@@ -466,7 +1474,7 @@ def should_create(member_name, dry_run):
     :rtype: bool
     """
     if dry_run:
-        logger.info(f"DRYRUN: Creating for member: {member_name}")
+        logger.log(member_log_level, f"DRYRUN: Creating for member: {member_name}")
         return False
     return True
 
@@ -480,8 +1488,8 @@ def build_claim(claim) -> dict:
     contains the processed claim information in a standardized format.
 
     :param claim: A dictionary containing claim information. It must have the
-        attribute 'ClaimType', and may include 'ClaimValue', 'Provider', and
-        'Description'.
+        attribute 'ClaimType', and may include 'ClaimValue', 'Provider' (or an
+        already built 'ProviderAuthenticationScheme'), and 'Description'.
     :type claim: dict
 
     :raises RuntimeError: If the provided 'ClaimType' is not recognized.
@@ -522,94 +1530,969 @@ def build_claim(claim) -> dict:
     return {
         "ClaimType": claim_type_num,
         "ClaimValue": claim.get("ClaimValue"),
-        "ProviderAuthenticationScheme": provider.get("AuthenticationScheme"),
+        "ProviderAuthenticationScheme": provider.get("AuthenticationScheme",
+                                                    claim.get("ProviderAuthenticationScheme")),
         "Description": claim.get("Description"),
     }
 
-def update_role(role, claim, name, dry_run):
+def update_role(role, claims, name, dry_run):
     """
-    Updates a role with a new claim and removes specified attributes before making an API request.
+    Updates a role with new claims and removes specified attributes before making an API request.
 
-    This function processes a role by building a new claims payload based on existing claims
-    and the provided claim. It updates the role's claims and removes certain attributes before
-    sending the updated role object to the Keyfactor API.
+    All the claims to add to the role are sent in a single PUT, together with the existing
+    claims built with build_claim. Claims already on the role are not added twice.
 
     :param role: A dictionary representing the role object to be updated. It must include
                  a "Claims" key as a list.
-    :param claim: A claim object to be appended to the role's claims list.
+    :param claims: The ClaimRecord objects to be appended to the role's claims list.
     :return: The response object in JSON format from the Keyfactor API if the request is
              successful. Returns "False" if an exception occurs during the API request.
     """
     if not should_create(name, dry_run):
         return
-    new_claims_payload = []
-    for rc in role["Claims"]:
-        new_claims_payload.append(build_claim(rc))
-    new_claims_payload.append(build_claim(claim))
-    role["Claims"] = new_claims_payload
-    del role["Immutable"]
+    new_claims_payload = [build_claim(rc) for rc in role["Claims"]]
+    existing = {(c["ClaimType"], c["ClaimValue"], c["ProviderAuthenticationScheme"]) for c in new_claims_payload}
+    for claim in claims:
+        built = build_claim(claim.to_dict())
+        key = (built["ClaimType"], built["ClaimValue"], built["ProviderAuthenticationScheme"])
+        if key not in existing:
+            existing.add(key)
+            new_claims_payload.append(built)
+    body = {key: value for key, value in role.items() if key != "Immutable"}
+    body["Claims"] = new_claims_payload
     try:
-        client = KeyfactorClient(variables)
-        response = client.put(f"Security/Roles", body=role, header_version=2)
+        client = keyfactor_client
+        response = client.put(f"Security/Roles", body=body, header_version=2)
         return response.json()
     except requests.exceptions.RequestException as e:
         logger.error(msg=f"updating role: {e}")
         return False
 
-def get_role(name):
+def get_role_details(role):
+    """
+    Loads the full payload of a role by Id, which update_role needs to send the whole role back.
+
+    Payloads are kept in the run-scoped role cache, so a role updated several times during the
+    run is only fetched once.
+
+    :param role: The role to load.
+    :type role: RoleRecord
+    :return: The role details, or False if the role could not be retrieved.
+    :rtype: dict | bool
+    """
+    details = role_cache.get(role.name)
+    if details is not None:
+        return details
     try:
-        client = KeyfactorClient(variables)
-        base_path = f"Security/Roles?QueryString=Name%20-eq%20%22{name}%22"
-        response = client.get(base_path, header_version=2)
-        total_count_header = response.headers.get("x-total-count")
-        if total_count_header is None:
-            return False
-        data = response.json()
-        id = data[0].get('Id') if data else None
-        base_path = f"Security/Roles/{id}"
-        response = client.get(base_path, header_version=2)
-        return response.json()
+        details = keyfactor_client.get(f"Security/Roles/{role.id}", header_version=2).json()
     except requests.exceptions.RequestException as e:
-        logger.error(msg=f"get roles: {e}")
+        logger.error(msg=f"get role {role.name}: {e}")
         return False
+    role_cache[role.name] = details
+    return details
 
-load_variables(environment)
-logger = get_logger()  # or logging.getLogger(__name__)
-logger.info(msg=f"Starting Script for environment: {environment}")
-logger.info(msg=f"Gathering all members of {variables['entra_all_users_group']} from gragh API's")
-entra_members = get_graph_transitive_members(variables["entra_all_users_group"])
-logger.info(msg=f"Gathering all roles from Keyfactor")
-roles = get_roles()
-logger.info(msg=f"Gathering all oauth claims from Keyfactor")
-claims = get_claims()
-for member in entra_members:
-    member_name = member.get("displayName")
-    newclaim = None
-    if not any(claim['ClaimValue'] == member_name for claim in claims):
-        logger.info(f"Member: {member_name} does not have a keyfactor claim. creating...")
+def resolve_roles(names, roles_index, cache_details: bool = True) -> dict:
+    """
+    Resolves the claim values of the named roles.
+
+    Roles whose listing entry already carried ``Claims`` need no request. The remaining roles
+    are fetched by Id concurrently, up to ``max_workers`` at a time, and their claim values are
+    stored on the RoleRecord. The full payload of a fetched role is only kept in the role cache
+    when the role lacks the claim of the member it is named after, since that role is about to
+    be updated.
+
+    :param names: The names of the roles to resolve.
+    :type names: iterable
+    :param roles_index: Keyfactor roles keyed by role name, from get_roles.
+    :type roles_index: dict
+    :param cache_details: If False, no payload is kept in the role cache, for callers that do
+        not update the roles.
+    :type cache_details: bool
+    :return: The resolved roles keyed by role name. Roles that could not be retrieved are left
+        out.
+    :rtype: dict
+    """
+    resolved = {}
+    to_fetch = []
+    for name in names:
+        role = roles_index.get(name)
+        if role is None:
+            continue
+        if role.claim_values is None:
+            to_fetch.append(role)
+        else:
+            resolved[name] = role
+
+    def fetch(role):
+        try:
+            return role, keyfactor_client.get(f"Security/Roles/{role.id}", header_version=2).json()
+        except requests.exceptions.RequestException as e:
+            logger.error(msg=f"get role {role.name}: {e}")
+            return role, None
+
+    def store(role, details):
+        if details:
+            role.claim_values = RoleRecord.from_api(details).claim_values
+            if cache_details and role.name not in role.claim_values:
+                role_cache[role.name] = details
+            resolved[role.name] = role
+
+    if len(to_fetch) == 1:
+        store(*fetch(to_fetch[0]))
+    elif to_fetch:
+        logger.info(f"Fetching details for {len(to_fetch)} roles")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for role, details in executor.map(fetch, to_fetch):
+                store(role, details)
+    return resolved
+
+SNAPSHOT_FORMAT = 2  # roles and claims stored as compact rows
+
+def load_snapshot():
+    """
+    Loads the local snapshot of the Keyfactor roles and claims.
+
+    The snapshot is ignored when it does not exist, cannot be read, was written in an older
+    format, was taken from another Keyfactor instance, or is older than ``snapshot_ttl_minutes``.
+
+    :return: The snapshot, with its roles and claims as RoleRecord and ClaimRecord lists, or
+        None if it cannot be used.
+    :rtype: dict | None
+    """
+    try:
+        with gzip.open(snapshot_file, "rt", encoding="utf-8") as file:
+            snapshot = json.load(file)
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            logger.info("Snapshot was written in an older format. Ignoring it.")
+            return None
+        taken = datetime.fromisoformat(snapshot["taken"])
+        if snapshot["keyfactordns"] != variables["keyfactordns"]:
+            logger.info("Snapshot was taken from another Keyfactor instance. Ignoring it.")
+            return None
+        if datetime.now() - taken > timedelta(minutes=snapshot_ttl_minutes):
+            logger.info(f"Snapshot taken at {snapshot['taken']} has expired. Ignoring it.")
+            return None
+        snapshot["roles"] = [RoleRecord(*row) for row in snapshot["roles"]]
+        snapshot["claims"] = [ClaimRecord(*row) for row in snapshot["claims"]]
+        logger.info(f"Using snapshot taken at {snapshot['taken']}: {len(snapshot['roles'])} roles, "
+                    f"{len(snapshot['claims'])} claims")
+        return snapshot
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Snapshot file {snapshot_file} is invalid ({e}). Ignoring it.")
+        return None
+
+def save_snapshot(roles: list, claims: list):
+    """
+    Saves the Keyfactor roles and claims to a local gzip-compressed snapshot, so later dry runs
+    can plan without downloading them again.
+
+    Each record is stored as a compact row. The claim values of the roles resolved during the
+    run are included, so those roles are not fetched again either.
+
+    :param roles: The roles returned by get_roles.
+    :type roles: list[RoleRecord]
+    :param claims: The claims returned by get_claims.
+    :type claims: list[ClaimRecord]
+    :return: None
+    """
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "taken": datetime.now().isoformat(),
+        "keyfactordns": variables["keyfactordns"],
+        "roles": [role.to_row() for role in roles],
+        "claims": [claim.to_row() for claim in claims],
+    }
+    temp_file = f"{snapshot_file}.tmp"
+    with gzip.open(temp_file, "wt", encoding="utf-8") as file:
+        json.dump(snapshot, file, separators=(",", ":"))
+    os.replace(temp_file, snapshot_file)
+    logger.info(f"Saved snapshot of {len(roles)} roles and {len(claims)} claims to {snapshot_file}")
+
+def count_resolved_roles(roles: list) -> int:
+    """
+    Counts the roles whose claim values are known.
+
+    :param roles: The roles returned by get_roles.
+    :type roles: list[RoleRecord]
+    :return: The number of roles with claim values.
+    :rtype: int
+    """
+    return sum(1 for role in roles if role.claim_values is not None)
+
+class ProvisioningJournal:
+    """
+    Append-only journal of the actions completed during a provisioning run.
+
+    Every completed action (claim created, role created, claim attached, member done) is written
+    as one JSON line. Writes are buffered and the file is flushed and fsynced once
+    ``journal_fsync_batch`` records are pending or ``journal_fsync_seconds`` have passed, so the
+    journal costs one disk sync per batch rather than one per action. A run started with
+    ``--resume`` replays the journal of the interrupted run to skip the work already done.
+
+    :ivar path: Path of the journal file.
+    :type path: str
+    """
+    def __init__(self, path: str, group_names: list, resume: bool):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+        if resume and self._file.tell() > 0:
+            with open(path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    self._file.write("\n")  # end the line cut off when the run was interrupted
+        if not resume or self._file.tell() == 0:
+            self._write({"action": "run_started", "group": group_names, "time": datetime.now().isoformat()})
+            self.flush()
+
+    @staticmethod
+    def replay(path: str, group_names: list) -> tuple:
+        """
+        Reads the journal left by an interrupted run.
+
+        :param path: Path of the journal file.
+        :type path: str
+        :param group_names: Names of the parent groups of the current run.
+        :type group_names: list[str]
+        :return: The names of the members that were completed, and the claims created keyed by
+            claim value, both empty when there is no journal, or None when the journal belongs
+            to other groups and must not be resumed.
+        :rtype: tuple[set, dict] | None
+        """
+        completed, created_claims = set(), {}
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # line cut off when the run was interrupted
+                    if entry["action"] == "run_started" and entry.get("group") != group_names:
+                        logger.warning(f"Journal {path} belongs to groups {entry.get('group')}. Not resuming.")
+                        return None
+                    if entry["action"] == "member_done":
+                        completed.add(entry["member"])
+                    elif entry["action"] == "claim_created":
+                        created_claims[entry["member"]] = entry["claim"]
+        except FileNotFoundError:
+            logger.info(f"No journal found at {path}. Starting from the beginning.")
+        return completed, created_claims
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._pending += 1
+
+    def record(self, action: str, member_name: str, **details):
+        with self._lock:
+            self._write({"action": action, "member": member_name, **details})
+            if self._pending >= journal_fsync_batch or time.monotonic() - self._last_sync >= journal_fsync_seconds:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+def skip_completed(entra_members, completed: set):
+    """
+    Yields the members that were not completed by the interrupted run being resumed.
+
+    :param entra_members: Entra group objects.
+    :type entra_members: Iterable[dict]
+    :param completed: Names of the members recorded as done in the journal.
+    :type completed: set
+    :return: Generator of the group objects still to reconcile.
+    :rtype: Iterator[dict]
+    """
+    for member in entra_members:
+        if member.get("displayName") not in completed:
+            yield member
+
+class ReconciliationPlan:
+    """
+    Holds the set of changes needed to bring Keyfactor Command in line with the Entra groups.
+
+    The plan is computed in a single pass over the Entra members using dictionary indexes built
+    once from the Keyfactor role and claim listings, so each membership check is a constant time
+    lookup instead of a scan of the full catalogs.
+
+    :ivar create_claims: Names of the members that need an OAuthRole claim created.
+    :type create_claims: list
+    :ivar create_roles: Names of the members that need a role created.
+    :type create_roles: list
+    :ivar attach_claims: Names of the members whose existing role is missing their claim.
+    :type attach_claims: list
+    :ivar roles_by_name: RoleRecords keyed by role name, for the roles in ``attach_claims``.
+    :type roles_by_name: dict
+    :ivar role_claims: Names of the members whose claim is attached to each role, keyed by role
+        name, so every role is updated once however many claims it receives.
+    :type role_claims: dict
+    :ivar unchanged: Number of members that already have a claim and a role containing it.
+    :type unchanged: int
+    :ivar members: Number of unique Entra members the plan was computed for.
+    :type members: int
+    :ivar names: Names of the unique Entra members, used by the pruning pass.
+    :type names: set
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = 0
+        self.names = set()
+        self.create_claims = []
+        self.create_roles = []
+        self.attach_claims = []
+        self.roles_by_name = {}
+        self.role_claims = {}
+        self.unchanged = 0
+
+    def size(self) -> int:
+        return len(self.create_claims) + len(self.create_roles) + len(self.attach_claims)
+
+    def summary(self) -> str:
+        return (f"{self.members} members: {len(self.create_claims)} claims to create, {len(self.create_roles)} roles to create, "
+                f"{len(self.attach_claims)} claims to attach to existing roles, {self.unchanged} unchanged")
+
+def build_index(items, key) -> dict:
+    """
+    Builds a dictionary index over a list of Keyfactor objects.
+
+    When several objects share the same key value the first one wins, which matches the
+    behaviour of the ``next(...)`` lookups the index replaces.
+
+    :param items: The list of records to index.
+    :type items: list[RoleRecord] | list[ClaimRecord]
+    :param key: The attribute whose value is used as the index key.
+    :type key: str
+    :return: A dictionary mapping each key value to its object.
+    :rtype: dict
+    """
+    index = {}
+    for item in items:
+        index.setdefault(getattr(item, key), item)
+    return index
+
+def plan_reconciliation(entra_members, roles_index, claims_index) -> ReconciliationPlan:
+    """
+    Computes the create-claim, create-role and attach-claim sets for the Entra members.
+
+    Each member is visited once. Members missing a claim or a role are added to the matching
+    create set. The claim values of the members' existing roles are then resolved together with
+    resolve_roles to check whether each member's claim is already attached.
+
+    :param entra_members: Entra group objects as yielded by get_graph_transitive_members.
+    :type entra_members: Iterable[dict]
+    :param roles_index: Keyfactor roles keyed by role name.
+    :type roles_index: dict
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :return: The reconciliation plan for the run.
+    :rtype: ReconciliationPlan
+    """
+    plan = ReconciliationPlan()
+    seen = plan.names
+    existing = []
+    for member in entra_members:
+        member_name = member.get("displayName")
+        if not member_name or member_name in seen:
+            continue
+        seen.add(member_name)
+        if member_name not in claims_index:
+            plan.create_claims.append(member_name)
+        if member_name not in roles_index:
+            plan.create_roles.append(member_name)
+        else:
+            existing.append(member_name)
+    plan.members = len(seen)
+    resolved_roles = resolve_roles(existing, roles_index)
+    for member_name in existing:
+        role = resolved_roles.get(member_name)
+        if not role:
+            logger.error(f"Member: {member_name} role details could not be retrieved. Skipping...")
+            continue
+        if member_name in claims_index and member_name in role.claim_values:
+            plan.unchanged += 1
+        else:
+            plan.attach_claims.append(member_name)
+            plan.roles_by_name[member_name] = role
+            plan.role_claims.setdefault(member_name, []).append(member_name)
+    return plan
+
+def provision_member(member_name: str, new_claim: bool, new_role: bool, role, claims_index: dict, dry_run: bool) -> str:
+    """
+    Applies the planned changes for a single member, in order.
+
+    The member's claim is created before its role is created or updated, so the role always
+    references a claim that exists. A newly created claim is added to ``claims_index``. Each
+    completed step is recorded in the journal.
+
+    :param member_name: The name of the member.
+    :type member_name: str
+    :param new_claim: Whether the member's claim has to be created.
+    :type new_claim: bool
+    :param new_role: Whether the member's role has to be created.
+    :type new_role: bool
+    :param role: The member's existing role when the claim has to be attached to it. Its full
+        payload is loaded with get_role_details before the update.
+    :type role: RoleRecord | None
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :param dry_run: If True, the changes are logged but not made.
+    :type dry_run: bool
+    :return: A short description of the outcome. Outcomes starting with ``failed`` mark errors.
+    :rtype: str
+    """
+    if new_claim:
+        logger.log(member_log_level, f"Member: {member_name} does not have a keyfactor claim. creating...")
         newclaim = create_claim(member_name, dry_run)
-    elif any(claim['ClaimValue'] == member_name for claim in claims):
-        logger.info(f"Member: {member_name} already has a keyfactor claim.  Checking roles...")
-    if not any(role['Name'] == member_name for role in roles):
-        logger.info(f"Member: {member_name} does not have a role. creating...")
-        if not newclaim:
-            claim = next((claim for claim in claims if claim['ClaimValue'] == member_name), None)
+        if newclaim is False:
+            return "failed: claim not created"
+        if newclaim:
+            claims_index[member_name] = ClaimRecord.from_api(newclaim)
+            if journal:
+                journal.record("claim_created", member_name, claim=newclaim)
+    claim = claims_index.get(member_name)
+    if new_role:
+        logger.log(member_log_level, f"Member: {member_name} does not have a role. creating...")
+        newrole = create_role(member_name, claim, dry_run)
+        if newrole is False:
+            return "failed: role not created"
+        if newrole and journal:
+            journal.record("role_created", member_name, role_id=newrole.get("Id"))
+        return "claim and role created" if new_claim else "role created"
+    if role:
+        logger.log(member_log_level, f"Member: {member_name} does not have a claim in role. adding claim to role...")
+        if not claim:
+            if dry_run:
+                return "claim attached"
+            logger.error(f"Member: {member_name} has no claim to add to role. Skipping...")
+            return "failed: no claim to attach"
+        details = {} if dry_run else get_role_details(role)
+        if details is False:
+            return "failed: role details could not be retrieved"
+        if update_role(details, [claim], member_name, dry_run) is False:
+            return "failed: role not updated"
+        if journal and not dry_run:
+            journal.record("claim_attached", member_name, role_id=role.id)
+        return "claim created and attached" if new_claim else "claim attached"
+    return "claim created"
+
+def future_outcome(member_name: str, future) -> str:
+    """
+    Returns the outcome of a member's provisioning task, turning an unexpected exception raised by
+    the task into a ``failed`` outcome.
+
+    :param member_name: The name of the member.
+    :type member_name: str
+    :param future: The completed future of the member's task.
+    :type future: concurrent.futures.Future
+    :return: The outcome of the member.
+    :rtype: str
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        logger.error(f"Member: {member_name} could not be provisioned: {e}")
+        return f"failed: {e}"
+
+def record_outcome(results: dict, member_name: str, outcome: str, dry_run: bool):
+    """
+    Stores the outcome of a member in ``results``, logging it when ``member_log_summary`` is
+    enabled, and marks the member as done in the journal when it succeeded.
+
+    :param results: The outcomes collected so far, keyed by member name.
+    :type results: dict
+    :param member_name: The name of the member.
+    :type member_name: str
+    :param outcome: The outcome of the member.
+    :type outcome: str
+    :param dry_run: If True, the changes were logged but not made.
+    :type dry_run: bool
+    :return: None
+    """
+    if journal and not dry_run and not outcome.startswith("failed"):
+        journal.record("member_done", member_name)
+    if outcome != "unchanged":
+        results[member_name] = outcome
+        if member_log_summary and not outcome.startswith("failed"):
+            logger.info(f"{'DRYRUN: ' if dry_run else ''}Member: {member_name} {outcome}")
+
+def log_write_summary(results: dict):
+    """
+    Logs how many members were provisioned successfully, followed by each failed member.
+
+    :param results: The outcome of each provisioned member keyed by member name.
+    :type results: dict
+    :return: None
+    """
+    failed = sorted(name for name, outcome in results.items() if outcome.startswith("failed"))
+    logger.info(f"Write phase complete: {len(results) - len(failed)} members succeeded, {len(failed)} failed")
+    for member_name in failed:
+        logger.error(f"Member: {member_name} {results[member_name]}")
+
+def attach_role_claims(role_name: str, role, member_names: list, claims_index: dict, dry_run: bool) -> dict:
+    """
+    Attaches the claims of several members to one role with a single update.
+
+    The full payload of the role is loaded with get_role_details just before the update.
+
+    :param role_name: The name of the role.
+    :type role_name: str
+    :param role: The role to update.
+    :type role: RoleRecord
+    :param member_names: The names of the members whose claim is attached to the role.
+    :type member_names: list
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :param dry_run: If True, the changes are logged but not made.
+    :type dry_run: bool
+    :return: The outcome of each member keyed by member name.
+    :rtype: dict
+    """
+    outcomes = {}
+    claims = []
+    for member_name in member_names:
+        logger.log(member_log_level, f"Member: {member_name} does not have a claim in role. adding claim to role...")
+        claim = claims_index.get(member_name)
+        if claim:
+            claims.append(claim)
+            outcomes[member_name] = "claim attached"
+        elif dry_run:
+            outcomes[member_name] = "claim attached"
         else:
-            claim = newclaim
-        create_role(member_name, claim, dry_run)
-    elif any(role['Name'] == member_name for role in roles):
-        logger.info(f"Member: {member_name} already has a role. Checking if claim is in role...")
-        role = get_role(member_name)
-        if not any(claim['ClaimValue'] == member_name for claim in role['Claims']):
-            logger.info(f"Member: {member_name} does not have a claim in role. adding claim to role...")
-            if not newclaim:
-                claim = next((claim for claim in claims if claim['ClaimValue'] == member_name), None)
+            logger.error(f"Member: {member_name} has no claim to add to role. Skipping...")
+            outcomes[member_name] = "failed: no claim to attach"
+    if claims or dry_run:
+        details = {} if dry_run else get_role_details(role)
+        if details is False:
+            return {member_name: "failed: role details could not be retrieved" for member_name in outcomes}
+        if update_role(details, claims, role_name, dry_run) is False:
+            return {member_name: "failed: role not updated" for member_name in outcomes}
+        if journal and not dry_run:
+            for member_name, outcome in outcomes.items():
+                if not outcome.startswith("failed"):
+                    journal.record("claim_attached", member_name, role_id=role.id)
+    return outcomes
+
+def execute_plan(plan: ReconciliationPlan, claims_index: dict, dry_run: bool) -> dict:
+    """
+    Applies a reconciliation plan to Keyfactor Command.
+
+    Members are provisioned concurrently, up to ``max_workers`` at a time. Missing claims and
+    roles are created first, with provision_member keeping each member's own changes in order.
+    The claims to attach to existing roles are then gathered per role and each role is updated
+    with a single PUT by attach_role_claims. The outcome of every member is collected and a
+    summary is logged once all writes have finished.
+
+    :param plan: The plan computed by plan_reconciliation.
+    :type plan: ReconciliationPlan
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :param dry_run: If True, the changes are logged but not made.
+    :type dry_run: bool
+    :return: The outcome of each member keyed by member name.
+    :rtype: dict
+    """
+    new_claims = set(plan.create_claims)
+    new_roles = set(plan.create_roles)
+    members = list(dict.fromkeys(plan.create_claims + plan.create_roles))
+    attaching = {member_name for member_names in plan.role_claims.values() for member_name in member_names}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(provision_member, name, name in new_claims, name in new_roles,
+                            None, claims_index, dry_run): name
+            for name in members
+        }
+        for future in as_completed(futures):
+            member_name = futures[future]
+            if member_name in attaching:
+                results[member_name] = future_outcome(member_name, future)
             else:
-                claim = newclaim
-            if claim:
-                update_role(role, claim, member_name,dry_run)
-        else:
-            logger.info(f"Member: {member_name} already has a claim in role.  No action needed.")
+                record_outcome(results, member_name, future_outcome(member_name, future), dry_run)
+        futures = {}
+        for role_name, member_names in plan.role_claims.items():
+            ready = [name for name in member_names if not results.get(name, "").startswith("failed")]
+            if ready:
+                future = executor.submit(attach_role_claims, role_name, plan.roles_by_name[role_name], ready,
+                                         claims_index, dry_run)
+                futures[future] = ready
+        for future in as_completed(futures):
+            try:
+                outcomes = future.result()
+            except Exception as e:
+                outcomes = {member_name: f"failed: {e}" for member_name in futures[future]}
+            for member_name, outcome in outcomes.items():
+                if results.get(member_name) == "claim created" and not outcome.startswith("failed"):
+                    outcome = "claim created and attached"
+                record_outcome(results, member_name, outcome, dry_run)
+    log_write_summary(results)
+    return results
+
+def reconcile_member(member_name: str, plan: ReconciliationPlan, roles_index: dict, claims_index: dict,
+                     dry_run: bool) -> str:
+    """
+    Checks a single member against the Keyfactor indexes and provisions it straight away.
+
+    Used by stream_reconciliation, where members are reconciled as they arrive from Graph
+    instead of being planned all together first. The member is added to the matching sets
+    of ``plan`` so the totals can be reported at the end of the run.
+
+    :param member_name: The name of the member.
+    :type member_name: str
+    :param plan: The plan collecting the totals of the run. It is updated in place.
+    :type plan: ReconciliationPlan
+    :param roles_index: Keyfactor roles keyed by role name.
+    :type roles_index: dict
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :param dry_run: If True, the changes are logged but not made.
+    :type dry_run: bool
+    :return: ``unchanged``, or the outcome returned by provision_member.
+    :rtype: str
+    """
+    new_claim = member_name not in claims_index
+    new_role = member_name not in roles_index
+    role = None
+    if not new_role:
+        role = resolve_roles([member_name], roles_index).get(member_name)
+        if not role:
+            return "failed: role details could not be retrieved"
+        if not new_claim and member_name in role.claim_values:
+            with plan.lock:
+                plan.unchanged += 1
+            return "unchanged"
+    with plan.lock:
+        (plan.create_roles if new_role else plan.attach_claims).append(member_name)
+        if new_claim:
+            plan.create_claims.append(member_name)
+    return provision_member(member_name, new_claim, new_role, role, claims_index, dry_run)
+
+def stream_reconciliation(entra_members, roles_index: dict, claims_index: dict, dry_run: bool) -> tuple:
+    """
+    Reconciles the Entra members as they arrive from Graph instead of planning them all first.
+
+    A producer thread reads the members into a queue bounded by ``member_queue_size``, and each
+    member is reconciled by reconcile_member on a pool of ``max_workers`` threads. At most twice
+    ``max_workers`` members are in flight at once, so when Keyfactor is slower than Graph the
+    queue fills up and the producer stops requesting Graph pages until there is room again.
+    Memory stays flat regardless of the size of the parent group, and the first writes start as
+    soon as the first Graph page arrives.
+
+    :param entra_members: Entra group objects as yielded by get_entra_members.
+    :type entra_members: Iterable[dict]
+    :param roles_index: Keyfactor roles keyed by role name.
+    :type roles_index: dict
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :param dry_run: If True, the changes are logged but not made.
+    :type dry_run: bool
+    :return: The plan holding the totals of the run, and the outcome of each changed member
+        keyed by member name.
+    :rtype: tuple[ReconciliationPlan, dict]
+    """
+    member_queue = queue.Queue(maxsize=member_queue_size)
+    done = object()
+
+    def produce():
+        try:
+            for member in entra_members:
+                member_queue.put(member)
+        except Exception as e:
+            logger.error(f"Error reading Entra members: {e}")
+        finally:
+            member_queue.put(done)
+
+    producer = threading.Thread(target=produce, name="entra-producer", daemon=True)
+    producer.start()
+    plan = ReconciliationPlan()
+    results = {}
+    seen = plan.names
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+
+    def finished(member_name, future):
+        try:
+            record_outcome(results, member_name, future_outcome(member_name, future), dry_run)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            member = member_queue.get()
+            if member is done:
+                break
+            member_name = member.get("displayName")
+            if not member_name or member_name in seen:
+                continue
+            seen.add(member_name)
+            in_flight.acquire()
+            future = executor.submit(reconcile_member, member_name, plan, roles_index, claims_index, dry_run)
+            future.add_done_callback(functools.partial(finished, member_name))
+    producer.join()
+    plan.members = len(seen)
+    log_write_summary(results)
+    return plan, results
+
+def find_orphans(entra_names: set, roles_index: dict, claims_index: dict) -> tuple:
+    """
+    Computes the Keyfactor claims and roles left behind by Entra groups that are no longer under
+    the parent groups.
+
+    Orphaned claims are the OAuthRole claims of the ``scheme`` identity provider whose value is
+    not the name of a current Entra group. The role named after an orphaned claim is orphaned
+    too when it holds no claim other than that one. Roles extended by hand are kept, together
+    with the claim they hold. When the run is sharded only the orphans hashed to this shard are
+    returned.
+
+    A claim is only orphaned when no role other than the orphaned roles holds it, so the claims
+    of every role are resolved with resolve_roles. If the claims of any role cannot be read, no
+    claim is deleted, since any of them could be the one still holding the claim.
+
+    :param entra_names: Names of every Entra group under the parent groups.
+    :type entra_names: set
+    :param roles_index: Keyfactor roles keyed by role name.
+    :type roles_index: dict
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :return: The orphaned roles, the orphaned claims, and the orphaned claims kept because the
+        claims of some roles could not be read.
+    :rtype: tuple[list[RoleRecord], list[ClaimRecord], list[ClaimRecord]]
+    """
+    claims = [claim for name, claim in claims_index.items()
+              if claim.scheme == variables["scheme"] and name not in entra_names
+              and (shard_count == 1 or member_shard(name, shard_count) == shard_index)]
+    if not claims:
+        return [], [], []
+    resolved = resolve_roles(list(roles_index), roles_index, cache_details=False)
+    candidates = {claim.claim_value for claim in claims}
+    roles = [role for name, role in resolved.items()
+             if name in candidates and set(role.claim_values) <= {role.name}]
+    orphan_roles = {role.name for role in roles}
+    referenced = {value for name, role in resolved.items() if name not in orphan_roles
+                  for value in role.claim_values}
+    claims = [claim for claim in claims if claim.claim_value not in referenced]
+    unresolved = len(roles_index) - len(resolved)
+    if unresolved:
+        logger.warning(f"The claims of {unresolved} roles could not be read. No orphaned claim will be deleted.")
+        return roles, [], claims
+    return roles, claims, []
+
+def delete_in_batches(endpoint: str, targets: dict, header_version: int, dry_run: bool) -> dict:
+    """
+    Deletes Keyfactor objects by Id in batches of ``prune_batch_size``.
+
+    The deletes of a batch are sent concurrently, up to ``max_workers`` at a time, and progress
+    is logged after each batch. Deleting stops early when every delete of a batch failed, since
+    the remaining ones would most likely fail the same way.
+
+    :param endpoint: The collection endpoint, such as ``Security/Roles``.
+    :type endpoint: str
+    :param targets: The Ids of the objects to delete keyed by name.
+    :type targets: dict
+    :param header_version: The Keyfactor API version of the endpoint.
+    :type header_version: int
+    :param dry_run: If True, the deletes are logged but not sent.
+    :type dry_run: bool
+    :return: The outcome of each object keyed by name.
+    :rtype: dict
+    """
+    if dry_run:
+        for name in targets:
+            logger.info(f"DRYRUN: Deleting {endpoint} {name}")
+        return {name: "would be deleted" for name in targets}
+
+    def delete(item):
+        name, object_id = item
+        try:
+            keyfactor_client.delete(f"{endpoint}/{object_id}", header_version=header_version)
+            return name, "deleted"
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Could not delete {endpoint} {name}: {e}")
+            return name, f"failed: {e}"
+
+    outcomes = {}
+    items = list(targets.items())
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(items), prune_batch_size):
+            batch = dict(executor.map(delete, items[start:start + prune_batch_size]))
+            outcomes.update(batch)
+            logger.info(f"{endpoint}: {len(outcomes)} of {len(items)} deletes sent")
+            if all(outcome.startswith("failed") for outcome in batch.values()):
+                logger.error(f"{endpoint}: every delete of the batch failed. Stopping.")
+                break
+    return outcomes
+
+def prune_orphan_groups(entra_names: set, roles_index: dict, claims_index: dict, dry_run: bool) -> dict:
+    """
+    Deletes the roles and claims of Entra groups that are no longer under the parent groups.
+
+    The orphans are computed by find_orphans. Nothing is deleted when there are more of them than
+    ``max_deletions``, which protects against a misconfigured parent group or an incomplete
+    Graph response. Roles are deleted before claims, and the claim of a role that could not be
+    deleted is kept.
+
+    :param entra_names: Names of every Entra group under the parent groups.
+    :type entra_names: set
+    :param roles_index: Keyfactor roles keyed by role name.
+    :type roles_index: dict
+    :param claims_index: Keyfactor OAuthRole claims keyed by claim value.
+    :type claims_index: dict
+    :param dry_run: If True, the orphans are reported but not deleted.
+    :type dry_run: bool
+    :return: The outcome of each orphaned role and claim, under the ``roles`` and ``claims`` keys.
+    :rtype: dict
+    """
+    roles, claims, unverified = find_orphans(entra_names, roles_index, claims_index)
+    logger.info(f"Found {len(roles)} orphaned roles and {len(claims)} orphaned claims")
+    unverified_outcomes = {claim.claim_value: "skipped: claims of other roles could not be read" for claim in unverified}
+    if len(roles) + len(claims) > max_deletions:
+        logger.error(f"{len(roles) + len(claims)} orphans exceed max_deletions ({max_deletions}). Nothing was deleted.")
+        skipped = "skipped: max_deletions exceeded"
+        return {"roles": {role.name: skipped for role in roles},
+                "claims": {**{claim.claim_value: skipped for claim in claims}, **unverified_outcomes}}
+    pruned = {"roles": delete_in_batches("Security/Roles", {role.name: role.id for role in roles}, 2, dry_run)}
+    kept = {name for name, outcome in pruned["roles"].items() if outcome.startswith("failed")}
+    pruned["claims"] = delete_in_batches(
+        "Security/Claims", {claim.claim_value: claim.id for claim in claims if claim.claim_value not in kept}, 1, dry_run)
+    for name in kept:
+        if name in claims_index:
+            pruned["claims"][name] = "skipped: role not deleted"
+    pruned["claims"].update(unverified_outcomes)
+    return pruned
+
+args = parse_arguments()
+if not (args.merge_reports or args.spawn_shards):
+    shard_count, shard_index = args.shard_count, args.shard_index
+load_variables(environment)
+logger = get_logger()  # or logging.getLogger(__name__)
+if args.merge_reports or args.spawn_shards:
+    completed = spawn_shards(args.shard_count, args.resume) if args.spawn_shards else True
+    completed = merge_shard_reports(args.shard_count) and completed
+    raise SystemExit(0 if completed else 1)
+metrics_file = shard_file(metrics_file)
+prometheus_textfile = shard_file(prometheus_textfile)
+delta_state_file = shard_file(delta_state_file)
+journal_file = shard_file(journal_file)
+snapshot_file = shard_file(snapshot_file)
+member_log_level = logging.DEBUG if member_log_summary else logging.INFO
+metrics = RunMetrics()
+keyfactor_session = create_session()
+graph_session = create_session()
+keyfactor_client = KeyfactorClient(variables, session=keyfactor_session)
+keyfactor_limiter = RateLimiter("Keyfactor", keyfactor_rate_limit)
+graph_limiter = RateLimiter("Graph", graph_rate_limit)
+role_cache = {}
+permission_set_cache = {}
+permission_set_lock = threading.Lock()
+token_provider = TokenProvider(
+    variables["token_url"],
+    data={
+        "grant_type": "client_credentials",
+        "client_id": variables["client_id"],
+        "client_secret": variables["client_secret"],
+        **({"scope": variables["scope"]} if variables.get("scope") else {}),
+        **({"audience": variables["audience"]} if variables.get("audience") else {}),
+    },
+    session=keyfactor_session,
+)
+graph_token_provider = TokenProvider(
+    variables["entra_token_url"],
+    data={
+        "grant_type": "client_credentials",
+        "client_id": variables["entra_client_id"],
+        "client_secret": variables["entra_client_secret"],
+        "scope": "https://graph.microsoft.com/.default"
+    },
+    session=graph_session,
+)
+logger.info(msg=f"Starting Script for environment: {environment}"
+                + (f", shard {shard_index} of {shard_count}" if shard_count > 1 else ""))
+snapshot = load_snapshot() if use_snapshot and dry_run and not refresh_snapshot else None
+if snapshot:
+    roles = snapshot["roles"]
+    claims = snapshot["claims"]
+else:
+    logger.info(msg=f"Gathering all roles from Keyfactor")
+    with metrics.phase("role_listing"):
+        roles = get_roles()
+    logger.info(msg=f"Gathering all oauth claims from Keyfactor")
+    with metrics.phase("claim_listing"):
+        claims = get_claims()
+    if roles is False or claims is False:
+        logger.error(msg="Could not load roles and claims from Keyfactor. Exiting.")
+        metrics.write()
+        raise SystemExit(1)
+source_groups = get_source_groups()
+logger.info(msg=f"Planning changes for members of {', '.join(source_groups)} from gragh API's")
+delta_state = (load_delta_state(source_groups) if incremental else None) or {}
+entra_members = get_entra_members(source_groups, delta_state)
+if shard_count > 1:
+    entra_members = filter_shard(entra_members)
+claims_index = build_index(claims, 'claim_value')
+roles_index = build_index(roles, 'name')
+completed_members = set()
+resume_journal = args.resume
+if args.resume:
+    replayed = ProvisioningJournal.replay(journal_file, source_groups)
+    resume_journal = replayed is not None
+    completed_members, journal_claims = replayed or (set(), {})
+    for member_name, claim in journal_claims.items():
+        claims_index.setdefault(member_name, ClaimRecord.from_api(claim))
+    if completed_members:
+        logger.info(msg=f"Resuming: skipping {len(completed_members)} members completed by the previous run")
+        entra_members = skip_completed(entra_members, completed_members)
+journal = None if dry_run else ProvisioningJournal(journal_file, source_groups, resume_journal)
+resolved_at_start = count_resolved_roles(roles)
+if stream_members:
+    if not dry_run:
+        prefetch_permission_sets()
+    with metrics.phase("streamed_reconciliation_and_writes"):
+        plan, results = stream_reconciliation(
+            metrics.timed_iter("graph_fetch", entra_members), roles_index, claims_index, dry_run)
+    logger.info(msg=f"Totals: {plan.summary()}")
+else:
+    planning_started = time.perf_counter()
+    plan = plan_reconciliation(metrics.timed_iter("graph_fetch", entra_members), roles_index, claims_index)
+    metrics.add_phase("reconciliation", time.perf_counter() - planning_started - metrics.phases.get("graph_fetch", 0.0))
+    logger.info(msg=f"Plan: {plan.summary()}")
+    if plan.create_roles and not dry_run:
+        prefetch_permission_sets()
+    with metrics.phase("writes"):
+        results = execute_plan(plan, claims_index, dry_run)
+if journal:
+    journal.close()
+entra_enumerated = delta_state.pop("enumerated", False)
+pruned = None
+if prune_orphans and not entra_enumerated:
+    logger.warning("Skipping pruning: the full membership of the parent groups was not read in this run")
+elif prune_orphans:
+    with metrics.phase("prune"):
+        pruned = prune_orphan_groups(plan.names | completed_members, roles_index, claims_index, dry_run)
+write_report(plan, results, pruned)
+if use_snapshot and dry_run and (not snapshot or count_resolved_roles(roles) > resolved_at_start):
+    save_snapshot(roles, claims)
+failed_members = [name for name, outcome in results.items() if outcome.startswith("failed")]
+if incremental and delta_state.pop("complete", False) and not dry_run:
+    if failed_members:
+        logger.warning(f"Not advancing the Graph delta link: {len(failed_members)} members failed and will be read again next run")
+    else:
+        save_delta_state(delta_state)
+log_pool_statistics("Keyfactor", keyfactor_session)
+log_pool_statistics("Graph", graph_session)
+metrics.write()
 if dry_run:
     logger.info(msg="DRYRUN: Done. Exiting.")
 else:
@@ -9,7 +9,13 @@ def get_config(env):
                         'audience': "",
                         'base_url': "",
                         'log_dir': r'',
-                        'csv_path': r''
+                        'csv_path': r'',
+                        'max_workers': 1,
+                        'prewarm_roles': False,
+                        'batch_serials': True,
+                        'max_url_length': 2000,
+                        'inventory_path': r'',
+                        'inventory_full_refresh_hours': 24
                 }
         elif env == 'dev':
                 return {
@@ -20,5 +26,11 @@ def get_config(env):
                         'audience': "",
                         'base_url': "",
                         'log_dir': r'',
-                        'csv_path': r''
+                        'csv_path': r'',
+                        'max_workers': 1,
+                        'prewarm_roles': False,
+                        'batch_serials': True,
+                        'max_url_length': 2000,
+                        'inventory_path': r'',
+                        'inventory_full_refresh_hours': 24
                 }
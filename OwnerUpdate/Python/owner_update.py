@@ -3,9 +3,13 @@ import requests
 import argparse
 import csv
 import json
+import sqlite3
 import urllib.parse
 import threading
+import functools
 import importlib.util
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 
 def dynamic_import(module_path: str, function_name: str):
@@ -31,6 +35,8 @@ class LogManager:
     :ivar log_dir: The directory path where log files will be stored.
     :type log_dir: str
     """
+    _lock = threading.Lock()  # shared by every instance, they all write to the same file
+
     def __init__(self, cm_config: dict):
         self.log_dir = cm_config['log_dir']
 
@@ -45,7 +51,7 @@ class LogManager:
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         log_entry = f"[{timestamp}] {entry}\n"
         log_file_path = os.path.join(self.log_dir, "application.log")
-        with open(log_file_path, "a") as log_file:
+        with self._lock, open(log_file_path, "a") as log_file:
             log_file.write(log_entry)
 
 class Authenticator:
@@ -120,27 +126,249 @@ class CertificateManager:
     :type serial: str, optional
     :ivar role: Name of the role associated with the instance (default is None).
     :type role: str, optional
+    :ivar session: Session shared by every request, with a connection pool large enough for
+        ``max_workers`` concurrent workers.
+    :type session: requests.Session
+    :ivar role_ids: Run-scoped cache of role Ids keyed by role name. Each entry is a Future, so
+        workers asking for a role that is being looked up wait for that lookup instead of
+        sending their own.
+    :type role_ids: dict
+    :ivar certificate_ids: Certificate Ids keyed by upper-case serial number, filled by
+        resolve_serials.
+    :type certificate_ids: dict
+    :ivar unresolved: Why a serial number could not be resolved by resolve_serials, keyed by
+        upper-case serial number.
+    :type unresolved: dict
+    :ivar owner_ids: The current owner role Id of each resolved certificate, keyed by upper-case
+        serial number.
+    :type owner_ids: dict
+    :ivar live_owners: Upper-case serial numbers whose owner in ``owner_ids`` was read from
+        Keyfactor during this run, rather than from the certificate inventory.
+    :type live_owners: set
+    :ivar max_url_length: Longest request URL sent when serial numbers are resolved in batches.
+    :type max_url_length: int
+    :ivar inventory: The local certificate inventory kept up to date with the owner changes, if
+        one is used.
+    :type inventory: CertificateInventory | None
     """
+    role_page_size = 100
+    certificate_page_size = 500
+
     def __init__(self, log_manager: LogManager, cm_config: dict, serial: str=None):
         self.log_manager = log_manager
         self.base_url = cm_config['base_url']
         self.token = cm_config['token']
         self.serial = serial
         self.role = None
+        self.session = requests.Session()
+        pool_size = max(10, cm_config.get('max_workers', 1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.role_ids = {}
+        self.role_lock = threading.Lock()
+        self.certificate_ids = {}
+        self.unresolved = {}
+        self.owner_ids = {}
+        self.live_owners = set()
+        self.max_url_length = cm_config.get('max_url_length', 2000)
+        self.inventory = None
 
     def get_certificates(self, serial: str):
+        key = serial.upper()
+        if key in self.certificate_ids:
+            return self.certificate_ids[key]
+        if key in self.unresolved:
+            return False
         try:
             encoded_query = urllib.parse.quote(f'SerialNumber -eq "{serial}"')
-            response = requests.get(f"{self.base_url}/Certificates?QueryString={encoded_query}",
+            response = self.session.get(f"{self.base_url}/Certificates?QueryString={encoded_query}",
                                     headers=KeyfactorHeaders(header_version='1', access_token=self.token).to_dict())
-            return json.loads(response.text)[0]["Id"]
+            response.raise_for_status()
+            certificates = json.loads(response.text)
+            if len(certificates) != 1:
+                self.log_manager.new_log_entry(f"[ERROR]{len(certificates)} certificates found with serial {serial}")
+                return False
+            self.owner_ids[key] = certificates[0].get("OwnerRoleId")
+            self.live_owners.add(key)
+            return certificates[0]["Id"]
         except Exception as e:
             self.log_manager.new_log_entry(f"Error fetching certificates: {str(e)}")
             return False
 
+    def list_certificates(self, query: str = None):
+        """
+        Yields every certificate matching a query, requesting ``certificate_page_size``
+        certificates per page.
+
+        :param query: A Keyfactor query string, or None for every certificate.
+        :return: Generator of certificates.
+        """
+        page = 1
+        while True:
+            url = f"{self.base_url}/Certificates?ReturnLimit={self.certificate_page_size}&PageReturned={page}"
+            if query:
+                url += f"&QueryString={urllib.parse.quote(query)}"
+            response = self.session.get(url, headers=KeyfactorHeaders(header_version='1', access_token=self.token).to_dict())
+            response.raise_for_status()
+            certificates = json.loads(response.text)
+            yield from certificates
+            if len(certificates) < self.certificate_page_size:
+                return
+            page += 1
+
+    def chunk_serials(self, serials: list):
+        """
+        Splits serial numbers into chunks whose OR-ed ``SerialNumber -eq`` query keeps the request
+        URL under ``max_url_length`` characters.
+
+        :param serials: The serial numbers to split.
+        :return: Generator of lists of serial numbers.
+        """
+        base_length = len(f"{self.base_url}/Certificates?ReturnLimit={self.certificate_page_size}"
+                          f"&PageReturned=100&QueryString=")
+        separator_length = len(urllib.parse.quote(" OR "))
+        chunk, length = [], base_length
+        for serial in serials:
+            term_length = len(urllib.parse.quote(f'SerialNumber -eq "{serial}"')) + separator_length
+            if chunk and length + term_length > self.max_url_length:
+                yield chunk
+                chunk, length = [], base_length
+            chunk.append(serial)
+            length += term_length
+        if chunk:
+            yield chunk
+
+    def resolve_serials(self, serials, max_workers: int = 1) -> dict:
+        """
+        Resolves serial numbers to certificate Ids with one ``Certificates`` query per chunk of
+        serial numbers, sending up to ``max_workers`` queries at the same time.
+
+        Serial numbers with no certificate, or with more than one, are recorded in
+        ``unresolved`` with the reason. Serial numbers of a chunk whose query failed are left
+        out of both, so get_certificates looks them up one by one.
+
+        :param serials: The serial numbers to resolve.
+        :param max_workers: The number of queries sent at the same time.
+        :return: The certificate Ids keyed by upper-case serial number.
+        """
+        unique = list(dict.fromkeys(serial.strip().upper() for serial in serials if serial.strip()))
+        queries = self.query_serials(unique, max_workers)
+        self.log_manager.new_log_entry(
+            f"Resolved {len(self.certificate_ids)} of {len(unique)} serial numbers with {queries} queries, "
+            f"{len(self.unresolved)} not resolved")
+        for serial, reason in self.unresolved.items():
+            self.log_manager.new_log_entry(f"[ERROR]Serial {serial}: {reason}")
+        return self.certificate_ids
+
+    def verify_owners(self, serials, max_workers: int = 1) -> int:
+        """
+        Reads the current owner of certificates from Keyfactor again, with the same batched
+        queries as resolve_serials, replacing the owners taken from the certificate inventory.
+
+        :param serials: The upper-case serial numbers to read again.
+        :param max_workers: The number of queries sent at the same time.
+        :return: The number of queries sent.
+        """
+        unique = list(dict.fromkeys(serials))
+        queries = self.query_serials(unique, max_workers) if unique else 0
+        self.log_manager.new_log_entry(f"Read the current owner of {len(unique)} certificates with {queries} queries")
+        return queries
+
+    def query_serials(self, serials: list, max_workers: int = 1) -> int:
+        """
+        Looks up upper-case serial numbers with one OR-ed ``Certificates`` query per chunk and
+        records the result of every query that succeeded with record_resolution.
+
+        :param serials: The unique upper-case serial numbers to look up.
+        :param max_workers: The number of queries sent at the same time.
+        :return: The number of queries sent.
+        """
+        def resolve(chunk):
+            query = " OR ".join(f'SerialNumber -eq "{serial}"' for serial in chunk)
+            try:
+                found = {}
+                for certificate in self.list_certificates(query):
+                    found.setdefault(certificate["SerialNumber"].upper(), []).append(
+                        (certificate["Id"], certificate.get("OwnerRoleId")))
+                return chunk, found
+            except Exception as e:
+                self.log_manager.new_log_entry(f"Error resolving {len(chunk)} serial numbers: {str(e)}")
+                return chunk, None
+
+        queries = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk, found in executor.map(resolve, self.chunk_serials(serials)):
+                queries += 1
+                if found is not None:
+                    self.record_resolution(chunk, found)
+        return queries
+
+    def record_resolution(self, serials: list, found: dict, live: bool = True):
+        """
+        Stores the certificate Id and current owner found for serial numbers, recording serial
+        numbers with no certificate or with more than one in ``unresolved``.
+
+        :param serials: The upper-case serial numbers that were looked up.
+        :param found: The Id and owner role Id of the certificates found, as lists of tuples keyed
+            by upper-case serial number.
+        :param live: Whether the owners were read from Keyfactor rather than from the certificate
+            inventory.
+        """
+        for serial in serials:
+            certificates = found.get(serial, [])
+            if len(certificates) == 1:
+                self.certificate_ids[serial], self.owner_ids[serial] = certificates[0]
+                self.unresolved.pop(serial, None)
+                if live:
+                    self.live_owners.add(serial)
+                continue
+            self.certificate_ids.pop(serial, None)
+            if not certificates:
+                self.unresolved[serial] = "certificate not found"
+            else:
+                self.unresolved[serial] = f"ambiguous serial: {len(certificates)} certificates"
+
+    def current_owner(self, serial: str):
+        """
+        Returns the owner role Id read from Keyfactor during this run, or None when the owner was
+        not read or only comes from the certificate inventory.
+        """
+        key = serial.upper()
+        return self.owner_ids.get(key) if key in self.live_owners else None
+
+    def record_owner(self, serial: str, owner_id: int):
+        """Stores the new owner of a certificate after its owner was updated."""
+        key = serial.upper()
+        self.owner_ids[key] = owner_id
+        self.live_owners.add(key)
+
+    def list_certificate_pages_after(self, last_id: int):
+        """
+        Yields pages of the certificates whose Id is greater than ``last_id``, in Id order.
+
+        Each page is requested with an ``Id -gt`` query starting after the last Id of the
+        previous page, so the listing never pages deep into the result set.
+
+        :param last_id: The Id to start after.
+        :return: Generator of lists of certificates.
+        """
+        while True:
+            encoded_query = urllib.parse.quote(f"Id -gt {last_id}")
+            response = self.session.get(
+                f"{self.base_url}/Certificates?QueryString={encoded_query}&ReturnLimit={self.certificate_page_size}"
+                f"&PageReturned=1&SortField=Id&SortAscending=0",
+                headers=KeyfactorHeaders(header_version='1', access_token=self.token).to_dict())
+            response.raise_for_status()
+            certificates = json.loads(response.text)
+            if certificates:
+                yield certificates
+            if len(certificates) < self.certificate_page_size:
+                return
+            last_id = max(certificate["Id"] for certificate in certificates)
+
     def check_keyfactor_status(self):
         try:
-            response = requests.get(f"{self.base_url}/status/healthcheck",
+            response = self.session.get(f"{self.base_url}/status/healthcheck",
                                     headers=KeyfactorHeaders(header_version='1', access_token=self.token).to_dict())
             return response.status_code == 204
         except Exception as e:
@@ -148,28 +376,236 @@ class CertificateManager:
             return False
 
     def get_roles(self, role: str):
+        """
+        Returns the Id of a role by name, looking each role up only once per run.
+
+        The first worker to ask for a role looks it up while the others wait for its result.
+        Roles that do not exist are cached as well. Lookups that fail with an error are not
+        cached, so a later row tries again.
+
+        :param role: The name of the role.
+        :return: The role Id, None if no role has that name, or False if the lookup failed.
+        """
+        with self.role_lock:
+            future = self.role_ids.get(role)
+            lookup = future is None
+            if lookup:
+                future = self.role_ids[role] = Future()
+        if lookup:
+            role_id = self.lookup_role(role)
+            if role_id is False:
+                with self.role_lock:
+                    del self.role_ids[role]
+            future.set_result(role_id)
+        return future.result()
+
+    def lookup_role(self, role: str):
         try:
             encoded_query = urllib.parse.quote(f'name -eq "{role}"')
-            response = requests.get(f"{self.base_url}/Security/Roles?QueryString={encoded_query}",
+            response = self.session.get(f"{self.base_url}/Security/Roles?QueryString={encoded_query}",
                                     headers=KeyfactorHeaders(header_version='2', access_token=self.token).to_dict())
-            return json.loads(response.text)[0]["Id"]
+            response.raise_for_status()
+            roles = json.loads(response.text)
+            if not roles:
+                self.log_manager.new_log_entry(f"[ERROR]Role {role} not found")
+                return None
+            return roles[0]["Id"]
         except Exception as e:
             self.log_manager.new_log_entry(f"Error fetching roles: {str(e)}")
             return False
 
+    def prewarm_roles(self):
+        """
+        Fills the role cache with every role from a paged listing of ``Security/Roles``, so rows
+        only look up roles created after the listing.
+
+        :return: The number of roles cached, or False if the listing failed.
+        """
+        try:
+            page = 1
+            total = None
+            count = 0
+            while total is None or count < total:
+                response = self.session.get(
+                    f"{self.base_url}/Security/Roles?ReturnLimit={self.role_page_size}&PageReturned={page}",
+                    headers=KeyfactorHeaders(header_version='2', access_token=self.token).to_dict())
+                response.raise_for_status()
+                total = int(response.headers.get("x-total-count", 0))
+                roles = json.loads(response.text)
+                if not roles:
+                    break
+                with self.role_lock:
+                    for role in roles:
+                        future = Future()
+                        future.set_result(role["Id"])
+                        self.role_ids.setdefault(role["Name"], future)
+                count += len(roles)
+                page += 1
+            self.log_manager.new_log_entry(f"Cached {count} roles")
+            return count
+        except Exception as e:
+            self.log_manager.new_log_entry(f"Error listing roles: {str(e)}")
+            return False
+
     def update_certificate_owner(self, certificate_id: str, owner_id: int):
         try:
             self.log_manager.new_log_entry(f"Updating certificate with id {certificate_id} with owner id {owner_id}")
-            response = requests.put(
+            response = self.session.put(
                 f"{self.base_url}/Certificates/{certificate_id}/Owner",
                 headers=KeyfactorHeaders(header_version='1', access_token=self.token).to_dict(),
                 json={"NewRoleId": owner_id}
             )
+            if response.status_code == 204 and self.inventory:
+                self.inventory.record_owner(certificate_id, owner_id)
             return response.status_code == 204
         except Exception as e:
             self.log_manager.new_log_entry(f"Error updating certificate: {str(e)}")
             return False
 
+class CertificateInventory:
+    """
+    Local SQLite index of the Keyfactor certificate inventory, holding the serial number, Id and
+    owner role Id of every certificate.
+
+    The index is filled by streaming the ``Certificates`` listing page by page. Later runs only
+    download the certificates with an Id greater than the highest one already stored, and rebuild
+    the index from scratch once it is older than ``inventory_full_refresh_hours``. Serial number
+    lookups are then answered from the index without any request.
+
+    Certificates already stored are not read again until the next rebuild, so owner changes made
+    outside this script, and certificates deleted or revoked since, are only as fresh as the last
+    full rebuild. Owner changes made by this script are written back to the index.
+
+    :ivar path: Path of the SQLite file.
+    :type path: str
+    :ivar full_refresh_hours: Age after which the index is rebuilt.
+    :type full_refresh_hours: int
+    :ivar owner_commit_size: Number of owner changes written back before they are committed.
+    :type owner_commit_size: int
+    """
+    owner_commit_size = 500
+
+    def __init__(self, log_manager: LogManager, cm_config: dict):
+        self.log_manager = log_manager
+        self.path = cm_config['inventory_path']
+        self.base_url = cm_config['base_url']
+        self.full_refresh_hours = cm_config.get('inventory_full_refresh_hours', 24)
+        self.lock = threading.Lock()
+        self.pending_owners = 0
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS certificates (
+                id INTEGER PRIMARY KEY,
+                serial TEXT NOT NULL,
+                owner_role_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS certificates_serial ON certificates (serial);
+            CREATE TABLE IF NOT EXISTS inventory_state (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def get_state(self, key: str):
+        row = self.connection.execute("SELECT value FROM inventory_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: str):
+        self.connection.execute("INSERT OR REPLACE INTO inventory_state (key, value) VALUES (?, ?)", (key, value))
+
+    def full_refresh_due(self) -> bool:
+        from datetime import datetime, timedelta
+        last_full_refresh = self.get_state("last_full_refresh")
+        if self.get_state("base_url") != self.base_url or not last_full_refresh:
+            return True
+        return datetime.now() - datetime.fromisoformat(last_full_refresh) > timedelta(hours=self.full_refresh_hours)
+
+    def refresh(self, certificate_manager: CertificateManager):
+        """
+        Brings the index up to date, rebuilding it when a full refresh is due and otherwise
+        adding the certificates issued since the last refresh. Each page is committed as it
+        arrives, and a rebuild is marked as in progress until its last page is stored, so an
+        interrupted rebuild resumes from the last page stored instead of starting over.
+
+        :param certificate_manager: The CertificateManager used to list the certificates.
+        :return: The number of certificates stored, or False if the listing failed.
+        """
+        from datetime import datetime
+        with self.lock:
+            resuming = self.get_state("rebuild_in_progress") == self.base_url
+            full = resuming or self.full_refresh_due()
+            if full and not resuming:
+                self.connection.execute("DELETE FROM certificates")
+                self.set_state("last_full_refresh", None)
+                self.set_state("base_url", self.base_url)
+                self.set_state("rebuild_in_progress", self.base_url)
+                self.connection.commit()
+            last_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM certificates").fetchone()[0]
+        if resuming:
+            self.log_manager.new_log_entry(f"Resuming certificate inventory rebuild after Id {last_id}")
+        count = 0
+        try:
+            for certificates in certificate_manager.list_certificate_pages_after(last_id):
+                with self.lock:
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO certificates (id, serial, owner_role_id) VALUES (?, ?, ?)",
+                        [(certificate["Id"], certificate["SerialNumber"].upper(), certificate.get("OwnerRoleId"))
+                         for certificate in certificates])
+                    self.connection.commit()
+                count += len(certificates)
+        except Exception as e:
+            self.log_manager.new_log_entry(f"Error refreshing certificate inventory: {str(e)}")
+            return False
+        if full:
+            with self.lock:
+                self.set_state("last_full_refresh", datetime.now().isoformat())
+                self.set_state("rebuild_in_progress", None)
+                self.connection.commit()
+        self.log_manager.new_log_entry(
+            f"{'Rebuilt' if full else 'Refreshed'} certificate inventory {self.path}: {count} certificates stored")
+        return count
+
+    def resolve(self, serials, certificate_manager: CertificateManager) -> dict:
+        """
+        Resolves serial numbers to certificate Ids from the index, recording them in the
+        CertificateManager as resolve_serials does.
+
+        :param serials: The serial numbers to resolve.
+        :param certificate_manager: The CertificateManager receiving the resolved Ids.
+        :return: The certificate Ids keyed by upper-case serial number.
+        """
+        unique = list(dict.fromkeys(serial.strip().upper() for serial in serials if serial.strip()))
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT serial, id, owner_role_id FROM certificates WHERE serial IN ({', '.join('?' * len(chunk))})",
+                    chunk).fetchall()
+            found = {}
+            for serial, certificate_id, owner_role_id in rows:
+                found.setdefault(serial, []).append((certificate_id, owner_role_id))
+            certificate_manager.record_resolution(chunk, found, live=False)
+        self.log_manager.new_log_entry(
+            f"Resolved {len(certificate_manager.certificate_ids)} of {len(unique)} serial numbers from the "
+            f"certificate inventory, {len(certificate_manager.unresolved)} not resolved")
+        for serial, reason in certificate_manager.unresolved.items():
+            self.log_manager.new_log_entry(f"[ERROR]Serial {serial}: {reason}")
+        return certificate_manager.certificate_ids
+
+    def record_owner(self, certificate_id: int, owner_id: int):
+        """
+        Stores the new owner of a certificate after its owner was updated. Changes are committed
+        every ``owner_commit_size`` updates and when the index is closed.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE certificates SET owner_role_id = ? WHERE id = ?", (owner_id, certificate_id))
+            self.pending_owners += 1
+            if self.pending_owners >= self.owner_commit_size:
+                self.connection.commit()
+                self.pending_owners = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
 class FileProcessor:
     """
     Handles file processing operations, including validation, file processing using multithreading,
@@ -180,10 +616,13 @@ class FileProcessor:
     :type csv_path: str
     :ivar log_manager: Instance of LogManager to handle logging operations.
     :type log_manager: LogManager
+    :ivar report_path: Path of the CSV report holding the result of every row.
+    :type report_path: str
     """
     def __init__(self, cm_config: dict):
         self.csv_path = cm_config['csv_path']
         self.log_manager = LogManager(cm_config=cm_config)
+        self.report_path = os.path.join(cm_config['log_dir'], "owner_update_report.csv")
 
     def validate_csv_file(self):
         required_headers = {'serial', 'role'}
@@ -197,32 +636,104 @@ class FileProcessor:
             self.log_manager.new_log_entry(f"Error validating CSV file: {str(e)}")
             return False
 
-    def process_file_multithreaded(self):
-        threads = []
-        with open(self.csv_path, 'r') as file:
-            for line in file:
-                thread = threading.Thread(target=self.process_line, args=(line,))
-                threads.append(thread)
-                thread.start()
-
-                # Optional: Limit the number of active threads
-                if len(threads) >= 10:  # Example: Max 10 threads
-                    for t in threads:
-                        t.join()
-                    threads = []
-        for t in threads:
-            t.join()
-
-    def process_line(self, line: str, certificate_manager: CertificateManager):
+    def read_lines(self):
+        """Yields the line number and text of every data row, skipping the header and blank lines."""
+        with open(self.csv_path, mode='r', encoding='utf-8-sig') as file:
+            next(file, None)
+            for line_number, line in enumerate(file, start=2):
+                if line.strip():
+                    yield line_number, line
+
+    def read_serials(self):
+        """Yields the serial number of every data row."""
+        for _, line in self.read_lines():
+            yield line.split(',')[0].strip()
+
+    def process_file_multithreaded(self, certificate_manager: CertificateManager, max_workers: int = 10) -> list:
+        """
+        Processes the rows of the CSV file concurrently on a pool of ``max_workers`` threads.
+
+        Rows are read one at a time and at most twice ``max_workers`` rows are submitted to the
+        pool at once, so memory stays flat however large the file is, and a slow request only
+        holds up its own worker.
+
+        :param certificate_manager: The CertificateManager used by every worker.
+        :param max_workers: The number of rows processed at the same time.
+        :return: The result of every row, in file order.
+        """
+        results = []
+        slots = threading.BoundedSemaphore(max_workers * 2)
+
+        def done(line_number, line, future):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                self.log_manager.new_log_entry(f"[ERROR]Error processing line {line_number}: {str(e)}")
+                results.append(self.row_result(line_number, line, "failed", str(e)))
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for line_number, line in self.read_lines():
+                slots.acquire()
+                future = executor.submit(self.process_line, line, certificate_manager, line_number)
+                future.add_done_callback(functools.partial(done, line_number, line))
+        return sorted(results, key=lambda result: result["line"])
+
+    @staticmethod
+    def row_result(line_number: int, line: str, status: str, message: str) -> dict:
+        """Builds the result of one row for the final report."""
+        columns = [column.strip() for column in line.split(',')]
+        return {
+            "line": line_number,
+            "serial": columns[0],
+            "role": columns[1] if len(columns) > 1 else "",
+            "status": status,
+            "message": message,
+        }
+
+    def process_line(self, line: str, certificate_manager: CertificateManager, line_number: int = None) -> dict:
+        if len(line.split(',')) < 2:
+            self.log_manager.new_log_entry(f"[ERROR]Line {line_number} does not have a serial and a role: {line.strip()}")
+            return self.row_result(line_number, line, "failed", "missing serial or role")
         certificate_id = certificate_manager.get_certificates(serial=line.split(',')[0].strip())
         role_id = certificate_manager.get_roles(role=line.split(',')[1].strip())
         if certificate_id and role_id:
+            serial = line.split(',')[0].strip()
+            if certificate_manager.current_owner(serial) == role_id:
+                self.log_manager.new_log_entry(f"Certificate with serial {serial} is already owned by role {line.split(',')[1].strip()}")
+                return self.row_result(line_number, line, "unchanged", "")
             if certificate_manager.update_certificate_owner(certificate_id=certificate_id, owner_id=role_id):
+                certificate_manager.record_owner(serial, role_id)
                 self.log_manager.new_log_entry(f"Certificate with serial {line.split(',')[0]} updated with role {line.split(',')[1]}")
+                return self.row_result(line_number, line, "updated", "")
             else:
                 self.log_manager.new_log_entry(f"[ERROR]Error updating certificate with serial {line.split(',')[0]} and role {line.split(',')[1]}")
+                return self.row_result(line_number, line, "failed", "owner update failed")
         else:
             self.log_manager.new_log_entry(f"[ERROR]Error updating certificate with serial {line.split(',')[0]} and role {line.split(',')[1]}")
+            serial = line.split(',')[0].strip()
+            message = (certificate_manager.unresolved.get(serial.upper(), "certificate not found")
+                       if not certificate_id else "role not found")
+            return self.row_result(line_number, line, "failed", message)
+
+    def write_report(self, results: list) -> dict:
+        """
+        Writes the result of every row to the CSV report in the log directory and logs the totals.
+
+        :param results: The row results returned by process_line.
+        :return: The number of rows for each status.
+        """
+        totals = {}
+        with open(self.report_path, mode='w', newline='', encoding='utf-8') as report_file:
+            writer = csv.DictWriter(report_file, fieldnames=["line", "serial", "role", "status", "message"])
+            writer.writeheader()
+            for result in results:
+                writer.writerow(result)
+                totals[result["status"]] = totals.get(result["status"], 0) + 1
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(totals.items())) or "no rows"
+        self.log_manager.new_log_entry(f"Processed {len(results)} rows: {summary}. Report written to {self.report_path}")
+        return totals
 
 class KeyfactorHeaders:
     """
@@ -277,11 +788,27 @@ class MainApplication:
     :ivar file_processor: Manages file processing, including validation and line processing
         functionalities.
     :type file_processor: FileProcessor
+    :ivar max_workers: Number of rows processed at the same time. Rows are processed one after
+        the other when it is 1.
+    :type max_workers: int
+    :ivar prewarm_roles: Whether every role is loaded into the role cache before the rows are
+        processed.
+    :type prewarm_roles: bool
+    :ivar batch_serials: Whether the serial numbers of the file are resolved in batches before
+        the rows are processed.
+    :type batch_serials: bool
+    :ivar inventory: The local certificate inventory used to resolve serial numbers instead of
+        querying Keyfactor, when ``inventory_path`` is configured.
+    :type inventory: CertificateInventory | None
     """
     def __init__(self, cm_config: dict):
         self.log_manager = LogManager(cm_config=cm_config)
         self.certificate_manager = CertificateManager(self.log_manager, cm_config=cm_config)
         self.file_processor = FileProcessor(cm_config=cm_config)
+        self.max_workers = max(1, cm_config.get('max_workers', 1))
+        self.prewarm_roles = cm_config.get('prewarm_roles', False)
+        self.batch_serials = cm_config.get('batch_serials', True)
+        self.inventory = CertificateInventory(self.log_manager, cm_config) if cm_config.get('inventory_path') else None
 
     def run(self):
         print("Creating Log Directory...")
@@ -292,12 +819,51 @@ class MainApplication:
             return
         else:
             self.log_manager.new_log_entry("CSV File validation successful.")
-        with open(self.file_processor.csv_path, 'r') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
+        if self.prewarm_roles:
+            print("Loading Roles...")
+            self.certificate_manager.prewarm_roles()
+        if self.inventory:
+            print("Refreshing Certificate Inventory...")
+            if self.inventory.refresh(self.certificate_manager) is False:
+                print("Certificate inventory could not be refreshed")
+                self.inventory.close()
+                return
+            self.inventory.resolve(self.file_processor.read_serials(), self.certificate_manager)
+            self.certificate_manager.inventory = self.inventory
+            self.verify_unchanged_owners()
+        elif self.batch_serials:
+            print("Resolving Serial Numbers...")
+            self.certificate_manager.resolve_serials(self.file_processor.read_serials(), self.max_workers)
+        if self.max_workers > 1:
+            print(f"Processing CSV File with {self.max_workers} workers...")
+            results = self.file_processor.process_file_multithreaded(self.certificate_manager, self.max_workers)
+        else:
             print("Processing CSV File...")
-            for line in file:
-                self.file_processor.process_line(line, self.certificate_manager)
+            results = [self.file_processor.process_line(line, self.certificate_manager, line_number)
+                       for line_number, line in self.file_processor.read_lines()]
+        totals = self.file_processor.write_report(results)
+        if self.inventory:
+            self.inventory.close()
+        print(f"Processed {len(results)} rows: {totals}. Report: {self.file_processor.report_path}")
+
+    def verify_unchanged_owners(self):
+        """
+        Reads again from Keyfactor the owner of every certificate that the certificate inventory
+        shows as already owned by its requested role, so a row is only reported as unchanged
+        when Keyfactor agrees. The other rows are updated anyway and need no check.
+        """
+        candidates = []
+        for _, line in self.file_processor.read_lines():
+            columns = [column.strip() for column in line.split(',')]
+            if len(columns) < 2:
+                continue
+            serial = columns[0].upper()
+            owner_id = self.certificate_manager.owner_ids.get(serial)
+            if owner_id is not None and owner_id == self.certificate_manager.get_roles(role=columns[1]):
+                candidates.append(serial)
+        if candidates:
+            print("Verifying Current Owners...")
+            self.certificate_manager.verify_owners(candidates, self.max_workers)
 
 def main():
     """
@@ -327,6 +893,11 @@ def main():
         help='prod or dev',
         required=True
     )
+    parser.add_argument(
+        '-w','--workers',
+        type=int,
+        help='Number of rows processed at the same time (overrides max_workers from the configuration file)'
+    )
 
     args = parser.parse_args()
 
@@ -337,6 +908,8 @@ def main():
     get_config = dynamic_import(args.config, 'get_config')
 
     config = get_config(env=args.env)
+    if args.workers:
+        config['max_workers'] = args.workers
 
     authenticator = Authenticator(token_url=config['token_url'], client_id=config['client_id'], client_secret=config['client_secret'], scope=config['scope'], audience=config['audience'])
     config['token'] = authenticator.get_bearer_token(scope=config['scope'])